@@ -0,0 +1,54 @@
+######## Camera calibration library for the RPI IR-Cut camera #########
+
+# Author: Petros626
+# Description:
+# The calibration, the image taker and the undistortion tools as one importable package. Importing
+# the package does no work: the modules (and with them OpenCV and Picamera2) are only imported
+# when one of their names is used, so loading a calibration or undistorting points in a long-lived
+# process doesn't pay for the camera or the GUI. The command line tools are run with
+# python3 -m camera_calibration <command> (see __main__.py).
+
+# Example usage:
+# from camera_calibration import load_parameters, PointUndistorter
+# mtx, dist = load_parameters("calibrate_camera.json", (1920, 1080))
+
+from importlib import import_module
+
+# Public names and the modules which define them
+EXPORTS = {
+    "CameraCalibrator": "calibrate_camera",
+    "ImageTaker": "ir_cut_picamera2_array",
+    "OnlineCalibrator": "online_calibration",
+    "calibrate_fleet": "calibrate_fleet",
+    "bootstrap_calibration": "bootstrap_uncertainty",
+    "load_calibration": "undistort_maps",
+    "build_undistort_maps": "undistort_maps",
+    "convert_camera_matrix": "undistort_maps",
+    "undistort_frame": "undistort_maps",
+    "load_parameters": "calib_bundle",
+    "load_maps": "calib_bundle",
+    "load_bundle": "calib_bundle",
+    "save_bundle": "calib_bundle",
+    "PointUndistorter": "undistort_points",
+    "open_source": "frame_sources",
+    "create_ring": "raw_ring",
+    "open_ring": "raw_ring",
+    "VideoUndistorter": "undistort_video",
+    "UndistortService": "undistort_service",
+    "UndistortClient": "undistort_service",
+}
+
+__all__ = sorted(EXPORTS)
+
+
+# Function to import the module of a public name on first use
+def __getattr__(name):
+    if name not in EXPORTS:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    value = getattr(import_module("." + EXPORTS[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
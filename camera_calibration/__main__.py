@@ -0,0 +1,56 @@
+######## Command line interface of the camera calibration #########
+
+# Author: Petros626
+# Description:
+# One entry point for all tools of the package. The command selects the module, all further
+# options are passed to it unchanged, so every tool keeps its own --help. Only the module of the
+# command is imported.
+
+# Example usage to calibrate the camera and to take undistorted images:
+# python3 -m camera_calibration calibrate --imgdir=calib_images --savedir=undistorted_images --board=9x6
+# python3 -m camera_calibration take --imgdir=images --res=1920x1080
+
+from importlib import import_module
+from sys import argv, exit
+
+# Commands with their module and a short description
+COMMANDS = {
+    "calibrate": ("calibrate_camera", "Calibrate the camera with the images of a folder."),
+    "take": ("ir_cut_picamera2_array", "Preview the undistorted camera and take images."),
+    "online": ("online_calibration", "Calibrate live while the board is moved in front of the camera."),
+    "fleet": ("calibrate_fleet", "Calibrate the image sets of many cameras in parallel."),
+    "ring": ("raw_ring", "Record raw frames into a ring file or extract them."),
+    "video": ("undistort_video", "Undistort a video file."),
+    "points": ("undistort_points", "Compare the point undistortion with the full frame remap."),
+    "service": ("undistort_service", "Run the resident undistortion service."),
+    "bundle": ("calib_bundle", "Write the binary calibration bundle and compare the load times."),
+    "maps": ("undistort_maps", "Compare undistort and remap with precomputed maps."),
+    "bench": ("benchmark_stages", "Benchmark the stages of the calibration."),
+}
+
+
+# Function to print the commands
+def print_usage():
+    print("usage: python3 -m camera_calibration <command> [options]\n\ncommands:")
+    for command, (_, description) in COMMANDS.items():
+        print("  {:<10} {}".format(command, description))
+    print("\nRun a command with --help for its options.")
+
+
+# Function to run the command of the arguments
+def main(args=None):
+    args = argv[1:] if args is None else args
+    if not args or args[0] in ("-h", "--help"):
+        print_usage()
+        return
+    if args[0] not in COMMANDS:
+        print("Unknown command '{}'.\n".format(args[0]))
+        print_usage()
+        exit(2)
+    # The tools print their usage with the command
+    argv[0] = "python3 -m camera_calibration " + args[0]
+    import_module("." + COMMANDS[args[0]][0], __package__).main(args[1:])
+
+
+if __name__ == "__main__":
+    main()
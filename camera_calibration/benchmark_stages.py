@@ -0,0 +1,232 @@
+######## Stage benchmark for the camera calibration and undistortion #########
+
+# Author: Petros626
+# Description:
+# This program times every stage of the calibration and undistortion on the bundled image sets:
+# decode, corner detection, subpixel refinement, calibrateCamera, re-projection, map building,
+# per-frame undistort vs. remap and PNG encode. Every stage runs for all given resolutions (scale
+# of the images) and OpenCV thread counts. Optionally the coarse-to-fine corner detection is validated
+# against the full resolution path (found views, corner deviation and time). The results are saved as JSON, so builds can be compared.
+# With --compare the results are checked against a previous JSON file and regressions are listed.
+
+# Example usage to benchmark both bundled sets at full and half resolution with 1 and 4 threads:
+# python3 -m camera_calibration bench --scales=1,0.5 --threads=1,4 --output=bench.json
+# Example usage to compare a new build with saved results (exit code 1 on regressions):
+# python3 -m camera_calibration bench --output=new.json --compare=bench.json
+
+from cv2 import (
+    TERM_CRITERIA_EPS, TERM_CRITERIA_MAX_ITER, COLOR_BGR2GRAY, CALIB_CB_ADAPTIVE_THRESH, CALIB_CB_FAST_CHECK, CALIB_CB_NORMALIZE_IMAGE,
+    INTER_AREA, IMWRITE_PNG_COMPRESSION, imread, imencode, cvtColor, resize, findChessboardCorners, cornerSubPix, calibrateCamera,
+    projectPoints, undistort, getOptimalNewCameraMatrix, setNumThreads, getNumThreads, __version__ as cv_version
+)
+from numpy import mgrid, zeros, float32, float64, asarray, sqrt, __version__ as np_version
+from glob import glob
+from os import path, cpu_count
+from time import perf_counter, strftime
+from platform import platform, machine, python_version
+from argparse import ArgumentParser
+from json import dump, load
+from sys import exit
+from .undistort_maps import build_undistort_maps, undistort_frame
+from .calibrate_camera import find_corners
+
+# Default image sets next to this script and their board dimensions
+DEFAULT_SETS = ["opencv_data:9x6", "undistorted_images:9x6"]
+
+
+# Function to run func and collect the duration in ms, the result of the last run is returned
+def timed(durations, func, *args, **kwargs):
+    start = perf_counter()
+    result = func(*args, **kwargs)
+    durations.append((perf_counter() - start) * 1000)
+    return result
+
+
+# Function to summarise the durations of a stage
+def summary(durations):
+    if not durations:
+        return None
+    ordered = sorted(durations)
+    return {"n": len(durations), "mean_ms": sum(durations) / len(durations), "median_ms": ordered[len(ordered) // 2],
+            "min_ms": ordered[0], "max_ms": ordered[-1]}
+
+
+# Function to load the images of a set, optionally downscaled
+def load_images(dirname, scale, stages):
+    images = sorted(glob(path.join(dirname, "*.png")) + glob(path.join(dirname, "*.jpg")))
+    frames = []
+    for fname in images:
+        img = timed(stages["decode"], imread, fname)
+        if scale != 1:
+            img = resize(img, None, fx=scale, fy=scale, interpolation=INTER_AREA)
+        frames.append(img)
+    return frames
+
+
+# Function to benchmark all stages for one image set, resolution and thread count
+def benchmark_set(dirname, board, scale, threads, repeat=3, pyramid=0):
+    setNumThreads(threads)
+    stages = {name: [] for name in ["decode", "find_corners", "corner_subpix", "calibrate_camera", "reprojection",
+                                    "build_maps", "undistort", "remap", "png_encode", "find_corners_pyramid"]}
+    frames = load_images(dirname, scale, stages)
+    h, w = frames[0].shape[:2]
+    checkerboard = tuple(map(int, board.split("x")))
+    flags = CALIB_CB_ADAPTIVE_THRESH + CALIB_CB_FAST_CHECK + CALIB_CB_NORMALIZE_IMAGE
+    criteria = (TERM_CRITERIA_EPS + TERM_CRITERIA_MAX_ITER, 30, 0.001)
+    objp = zeros((1, checkerboard[0] * checkerboard[1], 3), float32)
+    objp[0,:,:2] = mgrid[0:checkerboard[0], 0:checkerboard[1]].T.reshape(-1, 2)
+
+    # Corner detection and subpixel refinement
+    objpoints, imgpoints = [], []
+    deviations, found_pyramid, found_both = [], 0, 0
+    for img in frames:
+        gray = cvtColor(img, COLOR_BGR2GRAY)
+        start = perf_counter()
+        ret, corners = timed(stages["find_corners"], findChessboardCorners, gray, checkerboard, flags)
+        if ret == True:
+            corners_ = timed(stages["corner_subpix"], cornerSubPix, gray, corners, (11, 11), (-1, -1), criteria)
+            objpoints.append(objp)
+            imgpoints.append(corners_)
+        full_time = perf_counter() - start
+        
+        # Coarse-to-fine detection compared with the full resolution path (time includes the refinement)
+        if pyramid:
+            ret_pyramid, corners_pyramid = timed(stages["find_corners_pyramid"], find_corners, gray, checkerboard, flags, criteria, pyramid)
+            stages.setdefault("find_corners_full", []).append(full_time * 1000)
+            found_pyramid += ret_pyramid == True
+            if ret == True and ret_pyramid == True:
+                found_both += 1
+                # The board may be found in reversed order (rotated by 180 degrees), which is also a valid pose
+                deviation = min((sqrt(((candidate - corners_) ** 2).sum(axis=-1)).ravel() for candidate in (corners_pyramid, corners_pyramid[::-1])),
+                                key=lambda d: d.mean())
+                deviations.extend(deviation.tolist())
+
+    result = {"set": path.basename(path.normpath(dirname)), "board": board, "resolution": "{}x{}".format(w, h), "scale": scale,
+              "threads": threads, "images": len(frames), "views": len(objpoints)}
+    if pyramid:
+        result["pyramid"] = {"max_side": pyramid, "views": found_pyramid, "views_both": found_both,
+                             "mean_deviation_px": sum(deviations) / len(deviations) if deviations else None,
+                             "max_deviation_px": max(deviations) if deviations else None}
+        print("Pyramid ({} px): {}/{} views (full: {}), corner deviation mean {} px, max {} px".format(
+            pyramid, found_pyramid, len(frames), len(objpoints), result["pyramid"]["mean_deviation_px"], result["pyramid"]["max_deviation_px"]))
+    if len(objpoints) < 3:
+        print("{}: only {} views found, calibration stages skipped.".format(result["set"], len(objpoints)))
+        result["stages"] = {name: summary(values) for name, values in stages.items()}
+        return result
+
+    # Calibration and re-projection error
+    for _ in range(repeat):
+        ret, mtx, dist, rvecs, tvecs = timed(stages["calibrate_camera"], calibrateCamera, objpoints, imgpoints, (w, h), None, None)
+    for _ in range(repeat):
+        start = perf_counter()
+        projected = asarray([projectPoints(o, r, t, mtx, dist)[0] for o, r, t in zip(objpoints, rvecs, tvecs)], dtype=float64)
+        residuals = asarray(imgpoints, dtype=float64) - projected
+        sqrt((residuals ** 2).sum(axis=-1))
+        stages["reprojection"].append((perf_counter() - start) * 1000)
+
+    # Per-frame undistortion: undistort (with the optimal matrix per frame as before) vs. remap
+    for _ in range(repeat):
+        map1, map2, optimal_camera_matrix, roi = timed(stages["build_maps"], build_undistort_maps, mtx, dist, (w, h), 0)
+    dst = None
+    for img in frames:
+        start = perf_counter()
+        optimal, _ = getOptimalNewCameraMatrix(mtx, dist, (w, h), 0, (w, h))
+        undistort(img, mtx, dist, None, optimal)
+        stages["undistort"].append((perf_counter() - start) * 1000)
+        dst = timed(stages["remap"], undistort_frame, img, map1, map2, dst)
+        timed(stages["png_encode"], imencode, ".png", dst, [IMWRITE_PNG_COMPRESSION, 0])
+
+    result["stages"] = {name: summary(values) for name, values in stages.items()}
+    return result
+
+
+# Function to print the results as table
+def print_results(results):
+    for result in results:
+        print("\n{} ({}, {} threads, {}/{} views)".format(result["set"], result["resolution"], result["threads"], result["views"], result["images"]))
+        for name, stats in result["stages"].items():
+            if stats is not None:
+                print("  {:<17} {:>9.3f} ms (median {:>9.3f}, n={})".format(name, stats["mean_ms"], stats["median_ms"], stats["n"]))
+
+
+# Function to compare the results with a previous run, returns the list of regressions
+def compare_results(results, baseline, tolerance):
+    def key(result):
+        return result["set"], result["resolution"], result["threads"]
+
+    previous = {key(result): result for result in baseline["results"]}
+    regressions = []
+    print("\nComparison with the baseline (median, tolerance {:.0%}):".format(tolerance))
+    for result in results:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        for name, stats in result["stages"].items():
+            old_stats = old["stages"].get(name)
+            if stats is None or old_stats is None or old_stats["median_ms"] <= 0:
+                continue
+            change = stats["median_ms"] / old_stats["median_ms"] - 1
+            marker = ""
+            if change > tolerance:
+                marker = "  <- regression"
+                regressions.append((key(result), name, change))
+            print("  {} {} {} threads {:<17} {:>+7.1%}{}".format(result["set"], result["resolution"], result["threads"], name, change, marker))
+    return regressions
+
+
+# Function to run the command line interface
+def main(argv=None):
+    parser = ArgumentParser()
+    parser.add_argument("--set", action="append", help = "Image set as DIR:WxH (board dimensions), can be given multiple times. Default: the bundled sets.",
+                        default = None)
+    parser.add_argument("--scales", help = "Comma separated scales of the image resolution.",
+                        default = "1")
+    parser.add_argument("--threads", help = "Comma separated OpenCV thread counts.",
+                        default = "1,{}".format(cpu_count() or 1))
+    parser.add_argument("--repeat", type=int, help = "Number of runs for the calibration and map stages.",
+                        default = 3)
+    parser.add_argument("--pyramid", type=int, help = "Also validate the coarse-to-fine detection with this size of the longer side (0 = off).",
+                        default = 0)
+    parser.add_argument("--output", help = "JSON file for the results.",
+                        default = "benchmark_results.json")
+    parser.add_argument("--compare", help = "JSON file of a previous run to compare with.",
+                        default = None)
+    parser.add_argument("--tolerance", type=float, help = "Allowed slowdown of the median per stage before it counts as regression.",
+                        default = 0.1)
+    args = parser.parse_args(argv)
+
+    here = path.dirname(path.abspath(__file__))
+    sets = args.set or [path.join(here, s) for s in DEFAULT_SETS]
+    scales = [float(s) for s in args.scales.split(",")]
+    thread_counts = sorted({int(t) for t in args.threads.split(",")})
+    default_threads = getNumThreads()
+
+    results = []
+    for entry in sets:
+        dirname, board = entry.rsplit(":", 1)
+        if not "x" in board:
+            print("Specify dimensions with x as WxH. (Example: 9x6)")
+            exit()
+        for scale in scales:
+            for threads in thread_counts:
+                print("Benchmark {} at scale {:g} with {} threads...".format(dirname, scale, threads))
+                results.append(benchmark_set(dirname, board, scale, threads, args.repeat, args.pyramid))
+    setNumThreads(default_threads)
+
+    print_results(results)
+    report = {"meta": {"date": strftime("%Y-%m-%d %H:%M:%S"), "opencv": cv_version, "numpy": np_version, "python": python_version(),
+                       "platform": platform(), "machine": machine(), "cpu_count": cpu_count()},
+              "results": results}
+    with open(args.output, "w") as f:
+        dump(report, f, indent=4)
+    print("\nSave the results to -> {}.".format(args.output))
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = load(f)
+        if compare_results(results, baseline, args.tolerance):
+            exit(1)
+
+
+if __name__ == "__main__":
+    main()
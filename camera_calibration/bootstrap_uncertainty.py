@@ -0,0 +1,122 @@
+######## Bootstrap estimate of the calibration uncertainty #########
+
+# Author: Petros626
+# Description:
+# The calibration reports one solution and its re-projection error, but not how far the intrinsics
+# would move with another capture session. This module re-solves the calibration on many resampled
+# sets of the detected views (drawn with replacement) in a pool of processes. The views are sent
+# once to every worker process, a task only carries the indices of its views. The spread of the
+# solutions gives a confidence interval per intrinsic and distortion coefficient. Repeating this
+# for smaller numbers of views shows from how many views on the estimate is stable.
+
+# Example usage to calibrate and estimate the uncertainty with 200 resampled sets per size:
+# python3 -m camera_calibration calibrate --imgdir=calib_images --savedir=undistorted_images --bootstrap=200
+
+from cv2 import calibrateCamera, setNumThreads, error
+from numpy import array, asarray, float64, percentile, linspace, unique, random, median
+from concurrent.futures import ProcessPoolExecutor
+
+PARAMETER_NAMES = ["fx", "fy", "cx", "cy", "k1", "k2", "p1", "p2", "k3"]
+
+# Views of the worker process, set once by the initializer of the pool
+_views = None
+
+
+# Function to store the views in the worker process
+def init_worker(objpoints, imgpoints, img_size):
+    global _views
+    _views = (objpoints, imgpoints, img_size)
+    # One solve per process, OpenCV threads would only compete with the other processes
+    setNumThreads(1)
+
+
+# Function to solve the calibration with the views of the given indices, returns
+# (fx, fy, cx, cy, dist...) and the RMS, None if the solve failed
+def solve_views(indices):
+    objpoints, imgpoints, img_size = _views
+    try:
+        ret, mtx, dist, _, _ = calibrateCamera([objpoints[i] for i in indices], [imgpoints[i] for i in indices], img_size, None, None)
+    except error:
+        return None
+    return [mtx[0, 0], mtx[1, 1], mtx[0, 2], mtx[1, 2]] + list(asarray(dist).ravel()), ret
+
+
+# Function to draw samples sets of the given number of views with replacement, every set has at least
+# min_distinct different views (fewer can't constrain the intrinsics)
+def draw_samples(views, total, samples, rng, min_distinct=3):
+    sets = []
+    while len(sets) < samples:
+        indices = rng.integers(0, total, views)
+        if len(unique(indices)) >= min(min_distinct, total):
+            sets.append(sorted(int(i) for i in indices))
+    return sets
+
+
+# Function to estimate the uncertainty of the calibration. For every number of views in sizes
+# (default: a few steps up to all views) samples resampled sets are solved. Returns the confidence
+# intervals of all views and the spread per number of views.
+def bootstrap_calibration(objpoints, imgpoints, img_size, samples=200, sizes=None, workers=None, confidence=0.95, seed=0):
+    total = len(objpoints)
+    if sizes is None:
+        sizes = sorted(set(int(k) for k in linspace(min(5, total), total, 6)))
+    rng = random.default_rng(seed)
+    tasks = [(views, indices) for views in sizes for indices in draw_samples(views, total, samples, rng)]
+
+    results = {views: [] for views in sizes}
+    failed = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(objpoints, imgpoints, tuple(img_size))) as pool:
+        for (views, _), result in zip(tasks, pool.map(solve_views, [indices for _, indices in tasks], chunksize=8)):
+            if result is None:
+                failed += 1
+            else:
+                results[views].append(result[0])
+
+    tail = (1 - confidence) / 2 * 100
+    report = {"samples": samples, "confidence": confidence, "failed": failed, "sizes": {}}
+    for views in sizes:
+        params = array(results[views], dtype=float64)
+        if len(params) < 2:
+            continue
+        names = PARAMETER_NAMES[:params.shape[1]] + ["dist[{}]".format(i) for i in range(len(PARAMETER_NAMES), params.shape[1])]
+        low, high = percentile(params, [tail, 100 - tail], axis=0)
+        report["sizes"][views] = {name: {"median": float(m), "low": float(l), "high": float(h), "std": float(s)}
+                                  for name, m, l, h, s in zip(names, median(params, axis=0), low, high, params.std(axis=0))}
+    return report
+
+
+# Function to get the smallest number of views from which on the spread (standard deviation) of
+# fx, fy, cx and cy stays below tolerance times the focal length, None if it never does
+def stable_views(report, tolerance=0.005):
+    stable = None
+    for views in sorted(report["sizes"], reverse=True):
+        spread = report["sizes"][views]
+        focal = abs(spread["fx"]["median"])
+        if all(spread[name]["std"] <= tolerance * focal for name in ["fx", "fy", "cx", "cy"]):
+            stable = views
+        else:
+            break
+    return stable
+
+
+# Function to print the confidence intervals of all views and the spread per number of views
+def print_uncertainty(report, tolerance=0.005):
+    if not report["sizes"]:
+        print("Too few successful solves for an uncertainty estimate.")
+        return
+    total = max(report["sizes"])
+    print("\nBootstrap of {} views ({} resampled sets, {} failed solves), {:.0%} confidence intervals:".format(
+        total, report["samples"], report["failed"], report["confidence"]))
+    print("{:<8} | {:>12} | {:>12} | {:>12} | {:>10}".format("", "median", "low", "high", "std"))
+    for name, value in report["sizes"][total].items():
+        print("{:<8} | {:>12.5f} | {:>12.5f} | {:>12.5f} | {:>10.5f}".format(name, value["median"], value["low"], value["high"], value["std"]))
+
+    print("\nStandard deviation per number of views:")
+    print("{:>6} | {:>8} | {:>8} | {:>8} | {:>8} | {:>9} | {:>9}".format("views", "fx", "fy", "cx", "cy", "k1", "k2"))
+    for views, spread in sorted(report["sizes"].items()):
+        print("{:>6} | {:>8.3f} | {:>8.3f} | {:>8.3f} | {:>8.3f} | {:>9.5f} | {:>9.5f}".format(
+            views, *(spread[name]["std"] for name in ["fx", "fy", "cx", "cy", "k1", "k2"])))
+    stable = stable_views(report, tolerance)
+    if stable is None:
+        print("\nThe intrinsics aren't stable within {:.1%} of the focal length, capture more views.".format(tolerance))
+    else:
+        print("\nThe intrinsics are stable within {:.1%} of the focal length from {} views on.".format(tolerance, stable))
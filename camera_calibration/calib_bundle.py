@@ -0,0 +1,304 @@
+######## Binary calibration bundle for the RPI IR-Cut camera #########
+
+# Author: Petros626
+# Description:
+# The calibration is saved as nested JSON lists, so every tool has to parse the file and
+# rebuild the arrays and remap tables at startup. This module writes a versioned binary bundle
+# next to the calibration file, which holds the camera matrix, the distortion coefficients and
+# for every resolution/alpha the optimal camera matrix, the ROI and the remap tables.
+# The bundle is loaded with memory mapping, so there is no parsing and no map building at startup.
+# The JSON file stays the readable export for humans. The bundle records the resolution and the
+# sensor crop of the calibration images, so the camera matrix and the maps of any other mode
+# (resolution and crop) are derived without a new calibration and stored in the bundle as well.
+
+# Layout of the bundle (little endian):
+# MAGIC (8 bytes) | version (uint32) | header length (uint32) | header (JSON) | padding | arrays
+# The header describes every array with dtype, shape and offset. All arrays are 64 byte aligned.
+
+# Example usage to write the bundle and compare the load time of both formats:
+# python3 -m camera_calibration bundle --calib=calibrate_camera.json --res=1920x1080 --alpha=0
+
+from numpy import array, asarray, ascontiguousarray, dtype, float64, memmap, ndarray, uint8
+from os import path, replace, fdopen, chmod, remove
+from tempfile import mkstemp
+from json import load, loads, dumps, dump
+from struct import pack, unpack
+from time import perf_counter
+from argparse import ArgumentParser
+from .undistort_maps import load_calibration, build_undistort_maps, convert_camera_matrix
+
+MAGIC = b"CALIBBND"
+VERSION = 1
+ALIGN = 64
+
+
+# Define CalibrationBundle class to access the memory mapped arrays of a bundle
+class CalibrationBundle():
+    # Constructor with instance attributes
+    def __init__(self, filename, meta, arrays):
+        self.filename = filename
+        self.meta = meta
+        self.arrays = arrays
+        self.mtx = arrays["mtx"]
+        self.dist = arrays["dist"]
+        # Resolution and sensor crop of the calibration images, None if unknown
+        self.size = tuple(meta["size"]) if meta.get("size") else None
+        self.crop = tuple(meta["crop"]) if meta.get("crop") else None
+
+    # Function to list the stored modes (resolution and alpha)
+    def modes(self):
+        return sorted(name.split("/")[0] for name in self.arrays if name.endswith("/map1"))
+
+    # Function to get the maps of a mode, None if the mode isn't stored
+    def maps(self, size, alpha=0, out_size=None, crop=None):
+        key = mode_key(size, alpha, out_size, crop)
+        if key + "/map1" not in self.arrays:
+            return None
+        roi = tuple(int(v) for v in self.arrays[key + "/roi"])
+        return self.arrays[key + "/map1"], self.arrays[key + "/map2"], self.arrays[key + "/optimal_camera_matrix"], roi
+
+    # Function to get the camera matrix of the images of a mode (resolution and sensor crop)
+    def camera_matrix(self, size, crop=None):
+        key = camera_matrix_key(size, crop)
+        if key in self.arrays:
+            return self.arrays[key]
+        return mode_camera_matrix(self.mtx, self.meta, size, crop)
+
+
+# Function to get the name of a mode, e.g. 1920x1080_alpha0, 1920x1080_alpha0_out1000x900 or
+# 1296x972_alpha0_crop0_0_2592_1944 for a mode with a known sensor crop
+def mode_key(size, alpha, out_size=None, crop=None):
+    key = "{}x{}_alpha{:g}".format(size[0], size[1], alpha)
+    if out_size is not None and tuple(out_size) != tuple(size):
+        key += "_out{}x{}".format(out_size[0], out_size[1])
+    if crop is not None:
+        key += "_crop{}_{}_{}_{}".format(*crop)
+    return key
+
+
+# Function to get the name of the camera matrix of a resolution and crop (shared by all alphas)
+def camera_matrix_key(size, crop=None):
+    key = "{}x{}".format(size[0], size[1])
+    if crop is not None:
+        key += "_crop{}_{}_{}_{}".format(*crop)
+    return key + "/camera_matrix"
+
+
+# Function to derive the camera matrix of a mode from the calibration. Without a recorded resolution
+# the calibration is assumed to be made at the requested resolution (bundles of older versions).
+def mode_camera_matrix(mtx, meta, size, crop=None):
+    calib_size = meta.get("size")
+    calib_crop = meta.get("crop")
+    if calib_size is None or (tuple(size) == tuple(calib_size) and (crop is None or calib_crop is None or tuple(crop) == tuple(calib_crop))):
+        return asarray(mtx, dtype=float64)
+    return convert_camera_matrix(mtx, calib_size, size, calib_crop, crop)
+
+
+# Function to get the bundle file name next to the calibration file
+def bundle_filename(calib_file):
+    return path.splitext(path.abspath(calib_file))[0] + ".bundle"
+
+
+# Function to write all arrays and the meta data to a bundle file
+def write_bundle(filename, arrays, meta=None):
+    entries, offset = {}, 0
+    for name, arr in arrays.items():
+        arr = ascontiguousarray(arr)
+        entries[name] = {"dtype": arr.dtype.str, "shape": list(arr.shape), "offset": offset}
+        offset += (arr.nbytes + ALIGN - 1) // ALIGN * ALIGN
+    header = dumps({"meta": meta or {}, "arrays": entries}).encode("utf-8")
+    start = len(MAGIC) + 8 + len(header)
+    padding = (start + ALIGN - 1) // ALIGN * ALIGN - start
+
+    # Write to a unique temporary file first, so a running tool never maps a half written bundle and
+    # processes which write the bundle at the same time don't share the file
+    fd, tmp_filename = mkstemp(prefix=path.basename(filename) + ".", suffix=".tmp", dir=path.dirname(filename))
+    try:
+        with fdopen(fd, "wb") as f:
+            f.write(MAGIC + pack("<II", VERSION, len(header)) + header + bytes(padding))
+            for name, arr in arrays.items():
+                data = ascontiguousarray(arr).tobytes()
+                f.write(data + bytes((len(data) + ALIGN - 1) // ALIGN * ALIGN - len(data)))
+        # mkstemp creates the file only readable by the owner
+        chmod(tmp_filename, 0o644)
+        replace(tmp_filename, filename)
+    except BaseException:
+        remove(tmp_filename)
+        raise
+
+
+# Function to load a bundle, the arrays are read-only views of the memory mapped file
+def load_bundle(filename):
+    with open(filename, "rb") as f:
+        magic = f.read(len(MAGIC))
+        version, header_length = unpack("<II", f.read(8))
+        if magic != MAGIC:
+            raise ValueError("{} is no calibration bundle.".format(filename))
+        if version != VERSION:
+            raise ValueError("Calibration bundle version {} is not supported (expected {}).".format(version, VERSION))
+        header = loads(f.read(header_length).decode("utf-8"))
+    start = len(MAGIC) + 8 + header_length
+    start = (start + ALIGN - 1) // ALIGN * ALIGN
+
+    data = memmap(filename, dtype=uint8, mode="r")
+    arrays = {}
+    for name, entry in header["arrays"].items():
+        arrays[name] = ndarray(tuple(entry["shape"]), dtype=dtype(entry["dtype"]), buffer=data, offset=start + entry["offset"])
+    return CalibrationBundle(filename, header["meta"], arrays)
+
+
+# Function to get the arrays of a bundle, the maps are built for all given (size, alpha[, out_size[, crop]])
+# modes with the camera matrix of the mode
+def bundle_arrays(mtx, dist, modes=(), meta=None, arrays=None):
+    arrays = dict(arrays or {})
+    arrays["mtx"] = asarray(mtx, dtype=float64)
+    arrays["dist"] = asarray(dist, dtype=float64)
+    for mode in modes:
+        size, alpha = mode[:2]
+        out_size = mode[2] if len(mode) > 2 else None
+        crop = mode[3] if len(mode) > 3 else None
+        key = mode_key(size, alpha, out_size, crop)
+        camera_matrix = mode_camera_matrix(arrays["mtx"], meta or {}, size, crop)
+        arrays[camera_matrix_key(size, crop)] = camera_matrix
+        map1, map2, optimal_camera_matrix, roi = build_undistort_maps(camera_matrix, arrays["dist"], tuple(size), alpha, out_size)
+        arrays[key + "/map1"] = map1
+        arrays[key + "/map2"] = map2
+        arrays[key + "/optimal_camera_matrix"] = optimal_camera_matrix
+        arrays[key + "/roi"] = array(roi)
+    return arrays
+
+
+# Function to save a calibration as bundle with the maps of the given modes
+def save_bundle(filename, mtx, dist, modes=(), meta=None, arrays=None):
+    write_bundle(filename, bundle_arrays(mtx, dist, modes, meta, arrays), meta)
+
+
+# Function to save a calibration as bundle and to map it. If the bundle can't be written (e.g. a read-only
+# folder) or another process replaced it with a bundle without these modes, the arrays are used from memory.
+def store_bundle(filename, mtx, dist, modes=(), meta=None, arrays=None):
+    arrays = bundle_arrays(mtx, dist, modes, meta, arrays)
+    try:
+        write_bundle(filename, arrays, meta)
+        bundle = load_bundle(filename)
+    except OSError as e:
+        print("Warning: the bundle {} can't be written ({}), the maps are built in memory.".format(filename, e))
+        return CalibrationBundle(filename, meta or {}, arrays)
+    if not set(arrays) <= set(bundle.arrays):
+        return CalibrationBundle(filename, meta or {}, arrays)
+    return bundle
+
+
+# Function to check if the bundle exists and isn't older than the calibration file
+def bundle_is_current(calib_file):
+    filename = bundle_filename(calib_file)
+    return path.exists(filename) and (not path.exists(calib_file) or path.getmtime(filename) >= path.getmtime(calib_file))
+
+
+# Function to get the meta data of a calibration file for its bundle (resolution and sensor crop if known)
+def calibration_meta(calib_file):
+    with open(calib_file, "r") as f:
+        calibration_file = load(f)
+    meta = {"source": path.basename(calib_file)}
+    for key in ["size", "crop"]:
+        if calibration_file.get(key) is not None:
+            meta[key] = calibration_file[key]
+    return meta
+
+
+# Function to get only the camera matrix and the distortion coefficients, from the bundle if possible.
+# With size (and crop) the camera matrix is converted to this mode.
+def load_parameters(calib_file, size=None, crop=None):
+    if bundle_is_current(calib_file):
+        bundle = load_bundle(bundle_filename(calib_file))
+    else:
+        mtx, dist = load_calibration(calib_file)
+        bundle = store_bundle(bundle_filename(calib_file), mtx, dist, meta=calibration_meta(calib_file))
+    if size is None:
+        return bundle.mtx, bundle.dist
+    return bundle.camera_matrix(size, crop), bundle.dist
+
+
+# Function to get the camera parameters and the maps of a mode. The bundle is used, if it isn't
+# older than the calibration file. Otherwise, or if the mode is missing, the bundle is (re)written
+# (or the maps are only built in memory, if it can't be written).
+# The camera matrix is the one of the mode, derived from the calibration resolution and crop.
+def load_maps(calib_file, size, alpha=0, out_size=None, crop=None):
+    filename = bundle_filename(calib_file)
+    bundle = None
+    if bundle_is_current(calib_file):
+        bundle = load_bundle(filename)
+        maps = bundle.maps(size, alpha, out_size, crop)
+        if maps is not None:
+            return (bundle.camera_matrix(size, crop), bundle.dist) + maps
+
+    mode = [(size, alpha, out_size, crop)]
+    if bundle is not None:
+        # Keep the stored modes and add the new one
+        arrays = {name: arr.copy() for name, arr in bundle.arrays.items()}
+        bundle = store_bundle(filename, bundle.mtx, bundle.dist, mode, bundle.meta, arrays)
+    else:
+        mtx, dist = load_calibration(calib_file)
+        bundle = store_bundle(filename, mtx, dist, mode, calibration_meta(calib_file))
+    return (bundle.camera_matrix(size, crop), bundle.dist) + bundle.maps(size, alpha, out_size, crop)
+
+
+# Function to export the camera parameters of a bundle as readable JSON
+def export_json(bundle_file, json_file):
+    bundle = load_bundle(bundle_file)
+    calibrate_camera = dict(bundle.meta)
+    calibrate_camera["mtx"] = asarray(bundle.mtx).tolist()
+    calibrate_camera["dist"] = asarray(bundle.dist).tolist()
+    with open(json_file, "w") as f:
+        dump(calibrate_camera, f, indent=4)
+
+
+# Function to compare the startup of both formats: parse the JSON and build the maps vs. map the bundle
+def benchmark_load(calib_file, size, alpha=0, repeat=20):
+    filename = bundle_filename(calib_file)
+    with open(calib_file, "r") as f:
+        calibration_file = load(f)
+    meta = calibration_meta(calib_file)
+    meta["ret"] = calibration_file.get("ret")
+    save_bundle(filename, array(calibration_file["mtx"]), array(calibration_file["dist"]), [(size, alpha)], meta)
+
+    start = perf_counter()
+    for _ in range(repeat):
+        mtx, dist = load_calibration(calib_file)
+        build_undistort_maps(mtx, dist, size, alpha)
+    time_json = (perf_counter() - start) / repeat
+
+    start = perf_counter()
+    for _ in range(repeat):
+        bundle = load_bundle(filename)
+        bundle.maps(size, alpha)
+    time_bundle = (perf_counter() - start) / repeat
+
+    print("Resolution: {}x{}, alpha: {:g}, bundle size: {:.1f} MB".format(size[0], size[1], alpha, path.getsize(filename) / 1e6))
+    print("JSON + map building: {:.3f} ms".format(time_json * 1000))
+    print("Bundle (mmap):       {:.3f} ms".format(time_bundle * 1000))
+    return {"json": time_json, "bundle": time_bundle}
+
+
+# Function to run the command line interface
+def main(argv=None):
+    parser = ArgumentParser()
+    parser.add_argument("--calib", help = "Calibration file with the camera parameters.",
+                        default = "calibrate_camera.json")
+    parser.add_argument("--res", help = "Resolution in WxH of the stored maps.",
+                        default = "1920x1080")
+    parser.add_argument("--alpha", type=float, help = "Free scaling parameter of the optimal camera matrix (0 = only valid pixels, 1 = all pixels).",
+                        default = 0)
+    parser.add_argument("--repeat", type=int, help = "Number of loads to average.",
+                        default = 20)
+    args = parser.parse_args(argv)
+
+    if not "x" in args.res:
+        print("Specify resolution with x as WxH. (Example: 1920x1080).")
+        exit()
+    imgW, imgH = map(int, args.res.split("x"))
+
+    benchmark_load(args.calib, (imgW, imgH), args.alpha, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,176 +10,850 @@
 # The default directory is 'calib_images' and the default 'board' dimension is '6x9'.
 
 # Example usage to calibrate the camera with ckeckerboard images and defined dimensions:
-# python3 calibrate_camera.py --imgdir=calib_images --board=6x9
+# python3 -m camera_calibration calibrate --imgdir=calib_images --savedir=undistorted_images --board=6x9
+# Example usage as library:
+# from camera_calibration import CameraCalibrator
 
 # This code is based off the OpenCV-Python tutorials at:
 # https://docs.opencv.org/4.x/dc/dbb/tutorial_py_calibration.html
 
+# TODO: add comments for code
+
 from cv2 import (
-    TERM_CRITERIA_EPS, TERM_CRITERIA_MAX_ITER, COLOR_BGR2GRAY, CALIB_CB_ADAPTIVE_THRESH, CALIB_CB_FAST_CHECK, CALIB_CB_NORMALIZE_IMAGE, NORM_L2,
-    imread, imwrite, imshow, waitKey, destroyAllWindows, cvtColor, undistort, findChessboardCorners, cornerSubPix,
-    drawChessboardCorners, calibrateCamera, getOptimalNewCameraMatrix, projectPoints, norm
+    TERM_CRITERIA_EPS, TERM_CRITERIA_MAX_ITER, COLOR_BGR2GRAY, CALIB_CB_ADAPTIVE_THRESH, CALIB_CB_FAST_CHECK, CALIB_CB_NORMALIZE_IMAGE,
+    INTER_AREA, IMREAD_COLOR, imdecode, imwrite, imshow, waitKey, destroyAllWindows, cvtColor, undistort, findChessboardCorners, cornerSubPix,
+    drawChessboardCorners, calibrateCamera, getOptimalNewCameraMatrix, projectPoints, resize, Laplacian, CV_64F, setNumThreads
 )
-from numpy import mgrid, zeros, float32, asarray
+from numpy import mgrid, zeros, float32, float64, uint8, asarray, sqrt, frombuffer
 from glob import glob
-from time import sleep
-from os import getcwd, path, makedirs
+from time import sleep, perf_counter
+from os import getcwd, path, makedirs, cpu_count, replace, fdopen, chmod, remove
+from tempfile import mkstemp
 from argparse import ArgumentParser
-from json import JSONEncoder, dump
+from json import JSONEncoder, dump, load
+from hashlib import sha1
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import deque, OrderedDict
+from resource import getrusage, RUSAGE_SELF
+from functools import partial
+from threading import Lock
+from .undistort_maps import build_undistort_maps, undistort_frame
+from .calib_bundle import save_bundle, bundle_filename
+from .view_selection import view_features, select_views, sensor_coverage, evaluate_intrinsics
+from .bootstrap_uncertainty import bootstrap_calibration, print_uncertainty
+
+
+# Function to read the encoded file of an image once, so its content can be hashed and decoded
+def read_file(fname):
+    with open(fname, "rb") as f:
+        return f.read()
+
+
+# Function to hash the file content, changed images get detected again
+def content_hash(data):
+    return sha1(data).hexdigest()
+
+
+# Function to decode the encoded bytes of an image
+def decode_image(data):
+    return imdecode(frombuffer(data, uint8), IMREAD_COLOR)
+
+
+# Function to find and refine the corners in a grayscale image. With max_side the board is searched
+# on a copy downscaled to max_side pixels (coarse), the corners are scaled back up and refined
+# with cornerSubPix in full resolution (fine). Images without a board fail on the small copy.
+def find_corners(gray, checkerboard, flags, criteria, max_side=0):
+    scale = max_side / max(gray.shape) if max_side else 1
+    if scale < 1:
+        small = resize(gray, None, fx=scale, fy=scale, interpolation=INTER_AREA)
+        ret, corners = findChessboardCorners(small, checkerboard, flags)
+        if ret == True:
+            # Refine on the small image first, so the start points are close enough for the 11x11 window
+            corners = cornerSubPix(small, corners, (5, 5), (-1, -1), criteria)
+            corners = ((corners + 0.5) / scale - 0.5).astype(float32)
+    else:
+        ret, corners = findChessboardCorners(gray, checkerboard, flags)
+    
+    if ret == True:
+        # Refining pixel coordinates for given 2D points
+        return ret, cornerSubPix(gray, corners, (11, 11), (-1, -1), criteria)
+    return ret, None
+
+
+# Function to reject hopeless images before the full detection: blurry images (variance of the
+# Laplacian below min_sharpness) and images without a board in a quick check on a copy downscaled
+# to check_side pixels. Returns the reason of the rejection or None. 0 disables a check.
+def prescreen(gray, checkerboard, min_sharpness=0, check_side=0):
+    if min_sharpness:
+        sharpness = Laplacian(gray, CV_64F).var()
+        if sharpness < min_sharpness:
+            return "blurry (sharpness {:.1f} < {:g})".format(sharpness, min_sharpness)
+    if check_side:
+        scale = check_side / max(gray.shape)
+        small = resize(gray, None, fx=scale, fy=scale, interpolation=INTER_AREA) if scale < 1 else gray
+        ret, _ = findChessboardCorners(small, checkerboard, CALIB_CB_FAST_CHECK)
+        if ret == False:
+            return "no board in the {} px check".format(check_side)
+    return None
+
+
+# Function to initialize a worker process of the detection or the fleet. Every process works on its
+# own image or camera, OpenCV threads would only compete with the other processes.
+def init_detect_worker():
+    setNumThreads(1)
+
+
+# Function to find and refine the corners of a single image. It lives on module level,
+# so that it can be sent to the worker processes of the process pool. The file is read once for
+# the hash and the decoding, an image with the cached hash isn't decoded at all (detection None).
+# Returns the file name, the hash, the read bytes and the detection (ret, corners, size, time, reason).
+def detect_corners(fname, cached_hash, checkerboard, flags, criteria, max_side=0, min_sharpness=0, check_side=0):
+    start = perf_counter()
+    data = read_file(fname)
+    digest = content_hash(data)
+    if digest == cached_hash:
+        return fname, digest, len(data), None
+    gray = cvtColor(decode_image(data), COLOR_BGR2GRAY)
+    reason = prescreen(gray, checkerboard, min_sharpness, check_side)
+    if reason is not None:
+        return fname, digest, len(data), (False, None, gray.shape[::-1], perf_counter() - start, reason)
+    ret, corners_ = find_corners(gray, checkerboard, flags, criteria, max_side)
+    return fname, digest, len(data), (ret, corners_, gray.shape[::-1], perf_counter() - start, None)
+
+
+# Define FrameCache class, a size-limited cache of decoded images. The least recently added
+# image is evicted first, so the memory stays bounded on large sets.
+class FrameCache():
+    # Constructor with instance attributes
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes
+        self.frames = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    # Function to keep an image, if it fits at all
+    def put(self, fname, img):
+        if img.nbytes > self.max_bytes:
+            return
+        self.frames[fname] = img
+        self.nbytes += img.nbytes
+        while self.nbytes > self.max_bytes:
+            _, old = self.frames.popitem(last=False)
+            self.nbytes -= old.nbytes
+            self.evicted += 1
+
+    # Function to take an image out of the cache, None if it isn't cached
+    def pop(self, fname):
+        img = self.frames.pop(fname, None)
+        if img is None:
+            self.misses += 1
+            return None
+        self.nbytes -= img.nbytes
+        self.hits += 1
+        return img
+
+
+# Define CameraCalibrator class to calibrate the used camera
+class CameraCalibrator():
+    # Constructor with instance attributes
+    def __init__(self, imgdir, savedir, board, workers=1, use_cache=True, rebuild_cache=False, headless=False, threads=4,
+                 max_view_error=None, pyramid=0, min_sharpness=0, check_side=0, max_views=0, compare_views=False, frame_cache=0,
+                 crop=None, bootstrap=0):
+        self.imgdir = imgdir
+        self.savedir = savedir
+        self.dirpath = None
+        self.board = board
+        self.dirname = imgdir
+        self.objp = None
+        self.images = glob(self.dirname + "/*.png")
+        self.ret = None
+        self.flags = CALIB_CB_ADAPTIVE_THRESH + CALIB_CB_FAST_CHECK + CALIB_CB_NORMALIZE_IMAGE
+        self.objpoints = []
+        self.criteria = (TERM_CRITERIA_EPS + TERM_CRITERIA_MAX_ITER, 30, 0.001)
+        self.imgpoints = []
+        self.mtx = None
+        self.dist = None
+        self.rvecs = None
+        self.tvecs = None
+        self.optimal_camera_matrix = None
+        self.roi = None
+        self.mean_error = 0
+        self.filename = "calibrate_camera.json"
+        self.calibrate_camera = {}
+        self.save_name = "undistorted"
+        self.imgnum = 1
+        self.calib_flag = 1
+        self.workers = workers
+        self.img_size = None
+        self.use_cache = use_cache
+        self.rebuild_cache = rebuild_cache
+        self.cache_name = "corner_cache.json"
+        self.detections = {}
+        self.hashes = {}
+        self.cache_entries = {}
+        self.cache_hits = 0
+        self.headless = headless
+        self.threads = threads
+        self.max_view_error = max_view_error
+        self.pyramid = pyramid
+        self.min_sharpness = min_sharpness
+        self.check_side = check_side
+        self.detect_log = []
+        self.max_views = max_views
+        self.compare_views = compare_views
+        # Decoded images are only kept (up to frame_cache bytes) for the undistortion stage
+        self.frame_cache = FrameCache(frame_cache)
+        # Sensor crop (x, y, w, h) of the calibration images, so other modes can reuse the calibration
+        self.crop = crop
+        self.decoded = 0
+        self.bytes_read = 0
+        self.io_lock = Lock()
+        self.max_iterations = 10
+        self.view_names = []
+        self.per_corner_error = None
+        self.per_view_error = None
+        self.per_view_rms = None
+        # Number of resampled view sets per size for the uncertainty estimate (0 = off)
+        self.bootstrap = bootstrap
+        self.uncertainty = None
+     
+    # Function to check/initialize given board dimensions, raises ValueError for invalid dimensions
+    def check_board_dimensions(self):
+        if not "x" in self.board:
+            raise ValueError("Specify dimensions with x as WxH. (Example: 9x6)")
+        self.number_squares_x, self.number_squares_y = map(int, self.board.split("x"))
+        # set chessboard dimensions
+        self.CHECKERBOARD = (self.number_squares_x, self.number_squares_y)
+        
+        
+    # Function to output the user hints    
+    def preview(self):
+        print("\n#########################")
+        print("### Camera calibrater ###")
+        print("#########################")
+        print("For help run the script with the '--help' option.")
+        print("To quit the application press 'q'.\n")
+    
+    
+    # Function to set all directories
+    def set_dirs(self):
+        cwd = getcwd()
+        self.dirpath = path.join(cwd, self.savedir)
+        if not path.exists(self.dirpath):
+            makedirs(self.dirpath)    
+     
+     
+    # Function to setup the object points and their grid   
+    def setup_3d_points(self):
+        self.check_board_dimensions()
+        self.objp = zeros((1, self.CHECKERBOARD[0] * self.CHECKERBOARD[1], 3),float32)
+        self.objp[0,:,:2] = mgrid[0:self.CHECKERBOARD[0], 0:self.CHECKERBOARD[1]].T.reshape(-1, 2)
+        
+    
+    # Function find/draw the corners on chessboard
+    def find_draw_corners(self):
+        self.setup_3d_points()
+        self.preview()
+        print(f"{len(self.images)} images for calibration found.")
+        # Only new or changed images have to be detected again, the hash is taken while the image is read
+        self.load_corner_cache()
+        print(f"Start calibration with the {len(self.images)} calibration images...")
+        
+        if self.workers > 1:
+            self.find_corners_parallel()
+        else:
+            self.find_corners_serial(self.images)
+        print(f"{self.cache_hits} images loaded from the corner cache.")
+        self.print_prescreen_report()
+        self.save_corner_cache()
+        self.merge_corners()
+    
+    
+    # Function to read the file of an image and to count the read bytes
+    def read_file(self, fname):
+        data = read_file(fname)
+        with self.io_lock:
+            self.bytes_read += len(data)
+        return data
+    
+    
+    # Function to decode an image (also called by the undistortion threads). The encoded bytes are
+    # given, if the file was already read for the hash.
+    def read_image(self, fname, data=None):
+        if data is None:
+            data = self.read_file(fname)
+        with self.io_lock:
+            self.decoded += 1
+        return decode_image(data)
+    
+    
+    # Function to get the cached detection of an image, None if the image is new or changed
+    def cached_detection(self, fname, digest):
+        entry = self.cache_entries.get(path.basename(fname))
+        if entry is None or entry[0] != digest:
+            return None
+        return entry[1]
+    
+    
+    # Function to check the resolution of an image, the first image fixes the calibration resolution.
+    # Returns the reason of the rejection or None.
+    def check_image_size(self, img_size):
+        if self.img_size is None:
+            self.img_size = tuple(img_size)
+        elif tuple(img_size) != self.img_size:
+            return "resolution {}x{} differs from {}x{}".format(img_size[0], img_size[1], *self.img_size)
+        return None
+    
+    
+    # Generator which reads and decodes every image once and streams it through the detection. Only one
+    # image is alive at a time, unless it is kept in the frame cache for the undistortion. Unchanged
+    # images take their corners from the cache and aren't decoded.
+    def stream_detections(self, images):
+        for fname in images:
+            start = perf_counter()
+            data = self.read_file(fname)
+            if self.use_cache:
+                self.hashes[fname] = content_hash(data)
+                cached = self.cached_detection(fname, self.hashes[fname])
+                if cached is not None:
+                    # A cached image can fix the calibration resolution as well
+                    self.check_image_size(cached[2])
+                    self.detections[fname] = cached
+                    self.cache_hits += 1
+                    continue
+            img = self.read_image(fname, data)
+            img_size = img.shape[1::-1]
+            reason = self.check_image_size(img_size)
+            if reason is not None:
+                yield fname, img, False, None, img_size, perf_counter() - start, reason
+                continue
+            gray = cvtColor(img, COLOR_BGR2GRAY)
+            reason = prescreen(gray, self.CHECKERBOARD, self.min_sharpness, self.check_side)
+            if reason is None:
+                ret, corners_ = find_corners(gray, self.CHECKERBOARD, self.flags, self.criteria, self.pyramid)
+            else:
+                ret, corners_ = False, None
+            self.frame_cache.put(fname, img)
+            yield fname, img, ret, corners_, img_size, perf_counter() - start, reason
+    
+    
+    # Function to find the corners image by image with a preview of the drawn pattern
+    def find_corners_serial(self, images):
+        for fname, img, ret, corners_, img_size, elapsed, reason in self.stream_detections(images):
+            self.log_detection(fname, ret, elapsed, reason)
+            # Images with another resolution aren't cached, they are checked again next time
+            if reason is None or not reason.startswith("resolution"):
+                self.detections[fname] = (ret, corners_, img_size)
+            if self.headless:
+                continue
+            
+            if ret == True:
+                # Draw on a copy, the cached image is undistorted later
+                img_draw = drawChessboardCorners(img.copy(), self.CHECKERBOARD, corners_, ret)
+                imshow("Pattern draw on Checkerboard", img_draw)
+                
+            if waitKey(750) == ord('q'):
+                print("++++++++++++++++++++++++++++++++++++++++++++++")
+                print("Interruption: stop preview and calibration...")
+                break
+        if not self.headless:
+            destroyAllWindows()
+
+
+    # Function to find the corners with a pool of worker processes (no preview)
+    def find_corners_parallel(self, workers=None, images=None):
+        workers = workers or self.workers
+        images = self.images if images is None else images
+        detect = partial(detect_corners, checkerboard=self.CHECKERBOARD, flags=self.flags, criteria=self.criteria, max_side=self.pyramid,
+                         min_sharpness=self.min_sharpness, check_side=self.check_side)
+        start = perf_counter()
+        
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_detect_worker) as pool:
+            cached_hashes = [self.cache_entries.get(path.basename(fname), (None, None))[0] for fname in images]
+            results = list(pool.map(detect, images, cached_hashes, chunksize=max(1, len(images) // (workers * 4))))
+        
+        for fname, digest, nbytes, detection in results:
+            self.bytes_read += nbytes
+            if self.use_cache:
+                self.hashes[fname] = digest
+            if detection is None:
+                self.detections[fname] = self.cached_detection(fname, digest)
+                self.cache_hits += 1
+                continue
+            # The workers decode the images, they can't be kept for the undistortion
+            ret, corners_, img_size, elapsed, reason = detection
+            self.decoded += 1
+            self.log_detection(fname, ret, elapsed, reason)
+            self.detections[fname] = (ret, corners_, img_size)
+        
+        print("Corner detection with {} workers took {:.2f} s.".format(workers, perf_counter() - start))
+        return results
+    
+    
+    # Function to print the result of an image and to remember it for the pre-filter report
+    def log_detection(self, fname, ret, elapsed, reason):
+        self.detect_log.append((fname, ret, elapsed, reason))
+        if reason is None:
+            print("{} -> found: {} ({:.1f} ms)".format(path.basename(fname), ret, elapsed * 1000))
+        else:
+            print("{} -> rejected: {} ({:.1f} ms)".format(path.basename(fname), reason, elapsed * 1000))
+    
+    
+    # Function to report how many images the pre-filter kept/dropped and the estimated time saved
+    def print_prescreen_report(self):
+        if not (self.min_sharpness or self.check_side) or not self.detect_log:
+            return
+        kept = [entry for entry in self.detect_log if entry[3] is None]
+        dropped = [entry for entry in self.detect_log if entry[3] is not None]
+        blurry = sum(1 for entry in dropped if entry[3].startswith("blurry"))
+        # The dropped images would have cost about as much as the average full detection
+        mean_detection = sum(entry[2] for entry in kept) / len(kept) if kept else 0
+        saved = len(dropped) * mean_detection - sum(entry[2] for entry in dropped)
+        print("\nPre-filter: kept {}, dropped {} ({} blurry, {} without board), {} boards found.".format(
+            len(kept), len(dropped), blurry, len(dropped) - blurry, sum(1 for entry in kept if entry[1] == True)))
+        print("Estimated time saved: {:.2f} s.".format(saved))
+    
+    
+    # Function to collect the object/image points in the order of self.images,
+    # so the serial, parallel and cached paths give the same result
+    def merge_corners(self):
+        self.objpoints, self.imgpoints, self.view_names = [], [], []
+        for fname in self.images:
+            if fname not in self.detections:
+                continue
+            ret, corners_, img_size = self.detections[fname]
+            if ret == True:
+                # The parallel and cached detections are checked here, views with another resolution are dropped
+                reason = self.check_image_size(img_size)
+                if reason is not None:
+                    print("{} -> rejected: {}".format(path.basename(fname), reason))
+                    continue
+                self.objpoints.append(self.objp)
+                self.imgpoints.append(corners_)
+                self.view_names.append(path.basename(fname))
+    
+    
+    # Function to describe what the cached corners depend on besides the image content
+    def cache_key(self):
+        return {"board": list(self.CHECKERBOARD), "flags": self.flags, "criteria": list(self.criteria), "win_size": [11, 11],
+                "pyramid": self.pyramid, "min_sharpness": self.min_sharpness, "check_side": self.check_side}
+    
+    
+    # Function to load the cache entries, the corners of an image are taken during the detection
+    # if its hash is unchanged. A cache which can't be read counts as no cache.
+    def load_corner_cache(self):
+        self.detections = {}
+        self.hashes = {}
+        self.cache_entries = {}
+        self.cache_hits = 0
+        cache_path = path.join(self.imgdir, self.cache_name)
+        if not self.use_cache or self.rebuild_cache or not path.exists(cache_path):
+            return
+        
+        try:
+            with open(cache_path, "r") as f:
+                cache = load(f)
+        except (OSError, ValueError) as e:
+            print("Warning: the corner cache {} can't be read ({}), detect all images again.".format(cache_path, e))
+            return
+        if not isinstance(cache, dict) or not isinstance(cache.get("images"), dict):
+            print("Warning: the corner cache {} is broken, detect all images again.".format(cache_path))
+            return
+        if cache.get("key") != self.cache_key():
+            print("Corner cache was created with other settings, detect all images again.")
+            return
+        
+        # Entries are parsed once into (hash, detection), broken entries are detected again
+        for name, entry in cache["images"].items():
+            try:
+                corners_ = None if entry["corners"] is None else asarray(entry["corners"], dtype=float32).reshape(-1, 1, 2)
+                self.cache_entries[name] = (entry["hash"], (entry["ret"], corners_, tuple(entry["size"])))
+            except (KeyError, TypeError, ValueError):
+                continue
+    
+    
+    # Function to save the corners, entries of deleted images are dropped (eviction). The cache is
+    # only a shortcut, so a failed write is a warning.
+    def save_corner_cache(self):
+        if not self.use_cache:
+            return
+        entries = {}
+        for fname in self.images:
+            if fname not in self.detections:
+                continue
+            ret, corners_, img_size = self.detections[fname]
+            entries[path.basename(fname)] = {
+                "hash": self.hashes[fname],
+                "ret": bool(ret),
+                "corners": None if corners_ is None else corners_.tolist(),
+                "size": list(img_size),
+            }
+        cache_path = path.join(self.imgdir, self.cache_name)
+        # Write to a unique temporary file first, so an interrupted run never leaves a truncated cache
+        try:
+            fd, tmp_filename = mkstemp(prefix=self.cache_name + ".", suffix=".tmp", dir=self.imgdir)
+        except OSError as e:
+            print("Warning: the corner cache {} can't be written ({}).".format(cache_path, e))
+            return
+        try:
+            with fdopen(fd, "w") as f:
+                dump({"key": self.cache_key(), "images": entries}, f)
+            # mkstemp creates the file only readable by the owner
+            chmod(tmp_filename, 0o644)
+            replace(tmp_filename, cache_path)
+        except OSError as e:
+            remove(tmp_filename)
+            print("Warning: the corner cache {} can't be written ({}).".format(cache_path, e))
+        except BaseException:
+            remove(tmp_filename)
+            raise
+    
+    
+    # Function to measure the corner detection for an increasing number of worker processes
+    def benchmark_workers(self, max_workers=None):
+        self.setup_3d_points()
+        max_workers = max_workers or cpu_count() or 1
+        counts = [1]
+        while counts[-1] * 2 <= max_workers:
+            counts.append(counts[-1] * 2)
+        if counts[-1] != max_workers:
+            counts.append(max_workers)
+        
+        timings = {}
+        for workers in counts:
+            self.detections = {}
+            start = perf_counter()
+            self.find_corners_parallel(workers)
+            timings[workers] = perf_counter() - start
+        
+        print("\nWorkers | Time [s] | Speedup")
+        for workers, elapsed in timings.items():
+            print("{:>7} | {:>8.2f} | {:>6.2f}x".format(workers, elapsed, timings[1] / elapsed))
+        return timings
+
+
+    # Function execute the camera calibration and output their accuracy
+    def run_calibration(self):
+        self.find_draw_corners()
+        if self.max_views and len(self.objpoints) > self.max_views:
+            self.select_diverse_views()
+        else:
+            self.calibrate()
+        self.compute_reprojection_errors()
+        if self.max_view_error is not None:
+            self.reject_outliers()
+        w, h = self.img_size
+        # set alpha=0 keep minimum unwanted pixels, also comment l. 186-187
+        self.optimal_camera_matrix, self.roi = getOptimalNewCameraMatrix(self.mtx, self.dist, (w, h), 1, (w, h))
+        self.print_results()
+        if self.bootstrap:
+            self.estimate_uncertainty()
+    
+    
+    # Function to estimate the confidence intervals of the intrinsics by re-solving resampled view
+    # sets in a pool of processes (--workers, all cores by default)
+    def estimate_uncertainty(self):
+        start = perf_counter()
+        self.uncertainty = bootstrap_calibration(self.objpoints, self.imgpoints, self.img_size, self.bootstrap,
+                                                 workers=self.workers if self.workers > 1 else None)
+        print_uncertainty(self.uncertainty)
+        print("Bootstrap finished in {:.2f} s.\n".format(perf_counter() - start))
+    
+    
+    # Function to solve the calibration with the current views
+    def calibrate(self):
+        self.ret, self.mtx, self.dist, self.rvecs, self.tvecs= calibrateCamera(self.objpoints, self.imgpoints, self.img_size, None, None)
+    
+    
+    # Function to calibrate with at most max_views diverse views. With compare_views the calibration
+    # with all views is solved as well and both are evaluated on all views.
+    def select_diverse_views(self):
+        all_objpoints, all_imgpoints = self.objpoints, self.imgpoints
+        features = [view_features(corners_, self.CHECKERBOARD, self.img_size) for corners_ in all_imgpoints]
+        selected = select_views(features, self.max_views)
+        print("Selected {} of {} views, sensor coverage {:.0%} (all views: {:.0%}).".format(
+            len(selected), len(all_objpoints), sensor_coverage([all_imgpoints[i] for i in selected], self.img_size),
+            sensor_coverage(all_imgpoints, self.img_size)))
+        
+        if self.compare_views:
+            start = perf_counter()
+            self.calibrate()
+            time_all = perf_counter() - start
+            ret_all, mtx_all, dist_all = self.ret, self.mtx, self.dist
+        
+        self.objpoints = [all_objpoints[i] for i in selected]
+        self.imgpoints = [all_imgpoints[i] for i in selected]
+        self.view_names = [self.view_names[i] for i in selected]
+        start = perf_counter()
+        self.calibrate()
+        time_subset = perf_counter() - start
+        if not self.compare_views:
+            return
+        
+        print("\n{:<14} | {:>10} | {:>10} | {:>10}".format("", "all views", "subset", "difference"))
+        rows = [("views", len(all_objpoints), len(selected)), ("solve time [s]", time_all, time_subset),
+                ("RMS (solve)", ret_all, self.ret),
+                ("RMS (all)", evaluate_intrinsics(mtx_all, dist_all, all_objpoints, all_imgpoints),
+                 evaluate_intrinsics(self.mtx, self.dist, all_objpoints, all_imgpoints))]
+        rows += [(name, mtx_all[i, j], self.mtx[i, j]) for name, i, j in [("fx", 0, 0), ("fy", 1, 1), ("cx", 0, 2), ("cy", 1, 2)]]
+        rows += [("dist[{}]".format(i), value, self.dist.ravel()[i]) for i, value in enumerate(dist_all.ravel())]
+        for name, value_all, value_subset in rows:
+            print("{:<14} | {:>10.4f} | {:>10.4f} | {:>+10.4f}".format(name, value_all, value_subset, value_subset - value_all))
+        print()
+    
+    
+    # Function to calculate the re-projection error (accuracy of found parameters) per corner and per view.
+    # The projections are stacked to one (views, corners, 2) array, so the residuals are computed at once.
+    def compute_reprojection_errors(self):
+        projected = asarray([projectPoints(objp, rvec, tvec, self.mtx, self.dist)[0]
+                             for objp, rvec, tvec in zip(self.objpoints, self.rvecs, self.tvecs)], dtype=float64)
+        residuals = (asarray(self.imgpoints, dtype=float64) - projected).reshape(len(self.objpoints), -1, 2)
+        self.per_corner_error = sqrt((residuals ** 2).sum(axis=2))
+        squared_sum = (self.per_corner_error ** 2).sum(axis=1)
+        corners = self.per_corner_error.shape[1]
+        # Same measure as before: norm(imgpoints, imgpoints2, NORM_L2) / number of corners
+        self.per_view_error = sqrt(squared_sum) / corners
+        # Root mean square distance in pixels, used for the outlier rejection
+        self.per_view_rms = sqrt(squared_sum / corners)
+        self.mean_error = self.per_view_error.mean()
+    
+    
+    # Function to drop the views above the error threshold and recalibrate until the error converges
+    def reject_outliers(self):
+        for iteration in range(1, self.max_iterations + 1):
+            keep = self.per_view_rms <= self.max_view_error
+            if keep.all() or keep.sum() < 3:
+                break
+            dropped = [name for name, k in zip(self.view_names, keep) if not k]
+            print("Iteration {}: drop {} views above {} px -> {}".format(iteration, len(dropped), self.max_view_error, ", ".join(dropped)))
+            self.objpoints = [objp for objp, k in zip(self.objpoints, keep) if k]
+            self.imgpoints = [corners_ for corners_, k in zip(self.imgpoints, keep) if k]
+            self.view_names = [name for name, k in zip(self.view_names, keep) if k]
+            
+            previous_error = self.mean_error
+            self.calibrate()
+            self.compute_reprojection_errors()
+            print("Iteration {}: {} views, error {:.5f} -> {:.5f}".format(iteration, len(self.objpoints), previous_error, self.mean_error))
+            if abs(previous_error - self.mean_error) <= 1e-3 * previous_error:
+                break
+     
+     
+    # Function output the results of the calibration
+    def print_results(self):
+        print("Camera matrix: \n\n", self.mtx)
+        print("\n")
+        print("Distortion coefficient: \n\n", self.dist)
+        print("\n")
+        print("Rotation vectors: \n\n", self.rvecs)
+        print("\n")
+        print("Translation vectors: \n\n", self.tvecs)
+        print("\n")
+        print("New optimal camera matrix: \n\n", self.optimal_camera_matrix)
+        if not self.headless:
+            sleep(1.5)
+        print("\n\nRe-projection RMS per view [px]: \n")
+        for name, rms in zip(self.view_names, self.per_view_rms):
+            print("{} -> {:.4f}".format(name, rms))
+        print("\n\nEstimated error how accurate parameters are: \n\n{}\n".format(self.mean_error))
+    
+    
+    # Function to save the calculated parameters
+    def save_calib_params(self):
+        print("++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++")
+        print("Save the parameters to -> {}.\n".format(self.filename))
+        
+        for variable in ["ret", "mtx", "dist", "rvecs", "tvecs"]:
+            # Dynamically access the attribute
+            self.calibrate_camera[variable] = asarray(getattr(self, variable)).tolist() 
+        self.calibrate_camera["mean_error"] = float(self.mean_error)
+        self.calibrate_camera["views"] = self.view_names
+        self.calibrate_camera["per_view_error"] = self.per_view_error.tolist()
+        self.calibrate_camera["per_view_rms"] = self.per_view_rms.tolist()
+        self.calibrate_camera["per_corner_error"] = self.per_corner_error.tolist()
+        self.calibrate_camera["size"] = list(self.img_size)
+        self.calibrate_camera["crop"] = None if self.crop is None else list(self.crop)
+        if self.uncertainty is not None:
+            self.calibrate_camera["uncertainty"] = self.uncertainty
+        with open(self.filename, "w") as f:
+            dump(self.calibrate_camera, f, indent=4) 
+        # Binary bundle with the maps for the calibration resolution, loaded without parsing by the other tools
+        save_bundle(bundle_filename(self.filename), self.mtx, self.dist, [(self.img_size, 0), (self.img_size, 1)],
+                    {"ret": float(self.ret), "mean_error": float(self.mean_error), "size": list(self.img_size),
+                     "crop": self.calibrate_camera["crop"]})
+        print("Save the binary bundle to -> {}.\n".format(path.basename(bundle_filename(self.filename))))
+        if not self.headless:
+            sleep(1.5)
 
-#### Parser safety request #####
-# Fetch script arguments and define directory names
-parser = ArgumentParser()
-parser.add_argument("--imgdir", required=True, help = "Folder where the taken images for calibration are located.",
+
+    # Function to apply the parameters on all images
+    def undistort_images_save(self):
+        self.set_dirs()
+        print("++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++")
+        if self.headless:
+            print("Create the undistorted images without preview and save them.\n")
+            self.undistort_images_headless()
+            print("\nCalibration finished succesfully!")
+            return
+        print("Create the undistorted images in preview window and save them.\n")
+                
+        for fname in self.images:
+            img_dist = self.load_image(fname, self.frame_cache.pop(fname))
+            if img_dist is None:
+                continue
+            # Method 1: Compensate lens distortion (Renunciation of remapping method 2)
+            dst = undistort(img_dist, self.mtx, self.dist, None, self.optimal_camera_matrix)
+            # Crop the image. Uncomment these following two lines to remove black lines on the edge of the undistorted image
+            x, y, w, h = self.roi
+            dst = dst[y:y+h, x:x+w]
+            filename = "".join([self.save_name, "_", str(self.imgnum), ".png"])
+            savepath = path.join(self.dirpath, filename)
+            imwrite(savepath, dst)
+            print("Save undistorted image as -> {}.".format(filename))
+            imshow("Undistorted images preview", dst)
+            self.imgnum  += 1
+
+            if waitKey(750) == ord('q'):
+                self.calib_flag = 0
+                print("++++++++++++++++++++++++++++++++++++++++++++++")
+                print("Interruption: stop preview and calibration...")
+                break
+            
+        if self.calib_flag == 1:
+            print("\nCalibration finished succesfully!")      
+        destroyAllWindows()
+        self.print_io_report()
+    
+    
+    # Function to get an image for the undistortion, the cached image or from the disk. Images with
+    # another resolution than the calibration are skipped (None).
+    def load_image(self, fname, img=None):
+        if img is None:
+            img = self.read_image(fname)
+        if img.shape[1::-1] != self.img_size:
+            print("{} -> skipped: resolution {}x{} differs from {}x{}".format(path.basename(fname), img.shape[1], img.shape[0], *self.img_size))
+            return None
+        return img
+    
+    
+    # Function to report the decoded images, the read bytes and the peak memory of the process
+    def print_io_report(self):
+        print("\n{} decodes for {} images ({:.1f} MB read), frame cache: {} hits, {} misses, {} evicted.".format(
+            self.decoded, len(self.images), self.bytes_read / 1e6, self.frame_cache.hits, self.frame_cache.misses, self.frame_cache.evicted))
+        # ru_maxrss is given in kB on Linux
+        print("Peak RSS: {:.1f} MB".format(getrusage(RUSAGE_SELF).ru_maxrss / 1e3))         
+
+
+    # Function to undistort and save all images without preview and delay. Decode, remap and encode
+    # of different images overlap in a bounded pool of threads. The file numbers are given in order
+    # once an image is remapped, so skipped images leave no gap, like in the preview.
+    def undistort_images_headless(self):
+        map1, map2, _, _ = build_undistort_maps(self.mtx, self.dist, self.img_size, 1)
+        x, y, w, h = self.roi
+        
+        def undistort_image(fname, img_dist):
+            img_dist = self.load_image(fname, img_dist)
+            if img_dist is None:
+                return None
+            return undistort_frame(img_dist, map1, map2)[y:y+h, x:x+w]
+        
+        def save(filename, dst):
+            imwrite(path.join(self.dirpath, filename), dst)
+            return filename
+        
+        start = perf_counter()
+        remapped, saving = deque(), deque()
+        saved = 0
+        with ThreadPoolExecutor(max_workers=self.threads) as pool:
+            # Function to number the oldest remapped image and to queue it for saving
+            def number_next():
+                dst = remapped.popleft().result()
+                if dst is not None:
+                    filename = "".join([self.save_name, "_", str(self.imgnum), ".png"])
+                    self.imgnum += 1
+                    saving.append(pool.submit(save, filename, dst))
+            
+            for fname in self.images:
+                # The cached image is taken on this thread, so the cache is never shared with the pool
+                remapped.append(pool.submit(undistort_image, fname, self.frame_cache.pop(fname)))
+                while remapped and remapped[0].done():
+                    number_next()
+                # Bound the number of decoded images in memory
+                while len(remapped) + len(saving) >= 2 * self.threads:
+                    if saving:
+                        print("Save undistorted image as -> {}.".format(saving.popleft().result()))
+                        saved += 1
+                    else:
+                        number_next()
+            while remapped:
+                number_next()
+            while saving:
+                print("Save undistorted image as -> {}.".format(saving.popleft().result()))
+                saved += 1
+        
+        elapsed = perf_counter() - start
+        print("\n{} images undistorted in {:.2f} s ({:.1f} images/s).".format(saved, elapsed, saved / elapsed))
+        self.print_io_report()
+
+
+
+# Function to run the command line interface
+def main(argv=None):
+    # Fetch script arguments
+    parser = ArgumentParser()
+    parser.add_argument("--imgdir", required=True, help = "Folder where the taken images for calibration are located.",
                     default = "calib_images")
-parser.add_argument("--savedir", required=True, help = "Folder where the undistorted images are saved.",
+    parser.add_argument("--savedir", required=True, help = "Folder where the undistorted images are saved.",
                     default = "undistorted_images")
-parser.add_argument("--board", help = "Dimensions of your checkerboard on which the calibration shall be applied.",
+    parser.add_argument("--board", help = "Dimensions of your checkerboard on which the calibration shall be applied.",
                     default = "9x6")
-args = parser.parse_args()
-
-# Check if dimensions are specified correct
-if not "x" in args.board:
-    print("Specify dimensions with x as WxH. (Example: 9x6).")
-    exit()
-number_squares_x, number_squares_y = map(int, args.board.split("x"))
-
-# Set save directory and directory path
-cwd = getcwd()
-save_dir = args.savedir
-dirpath = path.join(cwd, save_dir)
-if not path.exists(dirpath):
-    makedirs(dirpath)
-    
-# --imgdir
-dirname = args.imgdir
-# Set save name
-save_name = "undistorted"
-
-#### Setup the real world coordinates of 3D points ####
-# Define chessboard dimensions
-# Termination criteria with termination type, number of iterations and the accuracy (ε)
-CHECKERBOARD = (number_squares_x, number_squares_y)
-criteria = (TERM_CRITERIA_EPS + TERM_CRITERIA_MAX_ITER, 30, 0.001)
-flags = CALIB_CB_ADAPTIVE_THRESH + CALIB_CB_FAST_CHECK + CALIB_CB_NORMALIZE_IMAGE
-# Creating arrays to store vectors of 3D points / 2D points for each checkerboard image
-objpoints  = [] # 3D - real world  
-imgpoints = [] # 2D - on image
-# Setup the object points and create an array 1x54x3
-# Create a meshgrid with the size of the checkerboard dimensions 
-objp = zeros((1, CHECKERBOARD[0] * CHECKERBOARD[1], 3), float32)
-objp[0,:,:2] = mgrid[0:CHECKERBOARD[0], 0:CHECKERBOARD[1]].T.reshape(-1, 2) 
-
-#### Get the images and apply find corner algorithm ####
-# Print program hints
-print("\n#########################")
-print("### Camera calibrater ###")
-print("#########################")
-print("For help run the script with the '--help' option.")
-print("To quit the application press 'q'.\n")
-
-# Get the file path for images in the current directory
-images = glob(dirname + "/*.png")
-print(f"{len(images)} images for calibration found.")
-print(f"Start calibration with the {len(images)} calibration images...")
-
-# Iterate through all images
-for fname in images:
-    img_dist = imread(fname)
-    gray = cvtColor(img_dist, COLOR_BGR2GRAY)
-    # Find corners on the chessboard
-    ret, corners = findChessboardCorners(gray, (number_squares_x, number_squares_y), flags)
-    # If found, add object points&image points (after refining them)
-    # print("status before: ",ret) # debug print
+    parser.add_argument("--workers", type=int, help = "Number of processes for the corner detection. With more than 1 worker the preview is skipped.",
+                    default = 1)
+    parser.add_argument("--no-cache", action="store_true", help = "Don't read or write the corner cache in the image folder.")
+    parser.add_argument("--rebuild-cache", action="store_true", help = "Invalidate the corner cache and detect all images again.")
+    parser.add_argument("--headless", action="store_true", help = "Run without preview windows and delays, the images are undistorted by a pool of threads.")
+    parser.add_argument("--threads", type=int, help = "Number of threads for the undistortion in headless mode.",
+                    default = 4)
+    parser.add_argument("--max-view-error", type=float, help = "Drop views with a higher re-projection RMS in px and recalibrate until the error converges.",
+                    default = None)
+    parser.add_argument("--pyramid", type=int, help = "Search the board on a copy downscaled to this size of the longer side, refine the corners in full resolution (0 = off).",
+                    default = 0)
+    parser.add_argument("--min-sharpness", type=float, help = "Reject images with a lower variance of the Laplacian before the detection (0 = off).",
+                    default = 0)
+    parser.add_argument("--check-size", type=int, help = "Reject images without a board in a quick check on a copy with this size of the longer side (0 = off).",
+                    default = 0)
+    parser.add_argument("--max-views", type=int, help = "Calibrate with at most this number of diverse views (board position, scale and tilt, 0 = all views).",
+                    default = 0)
+    parser.add_argument("--compare-views", action="store_true", help = "With --max-views also calibrate with all views and compare the intrinsics and errors.")
+    parser.add_argument("--frame-cache", type=int, help = "Keep up to this many MB of decoded images from the detection for the undistortion, saves decodes but raises the peak memory (0 = off, decode again).",
+                    default = 0)
+    parser.add_argument("--crop", help = "Sensor crop x,y,w,h (sensor pixels) of the calibration images, so modes with another crop can reuse the calibration.",
+                    default = None)
+    parser.add_argument("--bootstrap", type=int, help = "Estimate the confidence intervals of the intrinsics with this many resampled view sets per number of views (0 = off).",
+                    default = 0)
+    parser.add_argument("--bench", action="store_true", help = "Measure the corner detection speedup for 1 up to --workers processes and exit.")
+    args = parser.parse_args(argv)
     
-    if ret == True:
-        objpoints.append(objp)
-        # Refining pixel coordinates for given 2D points
-        corners_ = cornerSubPix(gray, corners, (11, 11), (-1, -1), criteria)
-        imgpoints.append(corners_)
-        # Draw and display the corners and delay the preview
-        img_draw = drawChessboardCorners(img_dist, (number_squares_x,number_squares_y), corners_, ret)
-        imshow("Pattern draw on Checkerboard", img_draw)
-    
-    # termination condition    
-    if waitKey(750) == ord('q'):
-        print("++++++++++++++++++++++++++++++++++++++++++++++")
-        print("Interruption: stop preview and calibration...")
-        break
-    
-destroyAllWindows()
-
-
-#### Calibrate camera, show parameters and show the accuracy ####
-# Apply the calibrate algorithm and print them
-ret, mtx, dist, rvecs, tvecs= calibrateCamera(objpoints, imgpoints, gray.shape[::-1], None, None)
-# Refine camera matrix, return optimal camera matrix and rectangular ROI (alpha=1, all pixels retained)
-# set alpha=0 keep minimum unwanted pixels, also comment l. 166-167
-h, w = img_dist.shape[:2]
-optimal_camera_matrix, roi = getOptimalNewCameraMatrix(mtx, dist, (w, h), 1, (w, h))
-
-# Re-projection error (accuracy of found parameters)
-mean_error = 0
-for i in range(len(objpoints)):
-    imgpoints2, _ = projectPoints(objpoints[i], rvecs[i], tvecs[i], mtx, dist)
-    error = norm(imgpoints[i], imgpoints2, NORM_L2) / len(imgpoints2)
-    mean_error += error
-
-#Show the parameters output
-print("Camera matrix: \n\n", mtx)
-print("\n")
-print("Distortion coefficient: \n\n",dist)
-print("\n")
-print("Rotation vectors: \n\n",rvecs)
-print("\n")
-print("Translation vectors: \n\n",tvecs)
-print("\n")
-print("New optimal camera matrix: \n\n", optimal_camera_matrix)
-sleep(1.5)
-print("\n\nEstimated error how accurate parameters are: \n\n{}\n".format(mean_error/len(objpoints)))
-
-#### Save parameters ####
-# Dictionary for parameters
-calibrate_camera = {}
-filename = "calibrate_camera.json"
-print("++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++")
-print("Save the camera parameters to -> {}.\n".format(filename))
-
-for variable in ["ret", "mtx", "dist", "rvecs", "tvecs"]:
-    calibrate_camera[variable] = asarray(eval(variable)).tolist() 
-with open(filename, "w") as f:
-    dump(calibrate_camera, f, indent=4)
- 
-sleep(1.5)
-
-#### Undistort the image ####
-imgnum  = 1
-calib_flag = 1
-print("++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++")
-print("Create the undistorted images in preview window and save them.\n")
-
-for fname in images:
-    img_dist = imread(fname)  
-    # Method 1: Compensate lens distortion (Renunciation of remapping method 2)
-    dst = undistort(img_dist, mtx, dist, None, optimal_camera_matrix)
-    # Crop the image. Uncomment these following two lines to remove black lines on the edge of the undistorted image
-    x, y, w, h = roi
-    dst = dst[y:y+h, x:x+w]
-    filename = "".join([save_name, "_", str(imgnum), ".png"])
-    savepath = path.join(dirpath, filename)
-    imwrite(savepath, dst)
-    print("Save undistorted image as -> {}.".format(filename))
-    imshow("Undistorted images preview", dst)
-    imgnum  += 1
-
-    # termination condition
-    if waitKey(750) == ord('q'):
-        calib_flag = 0
-        print("++++++++++++++++++++++++++++++++++++++++++++++")
-        print("Interruption: stop preview and calibration...")
-        break
-    
-if calib_flag == 1:
-    print("\nCalibration finished succesfully!")
-    
-destroyAllWindows()  
+    # Create an object calibrator of the class
+    calibrator = CameraCalibrator(args.imgdir, args.savedir, args.board, workers=args.workers, use_cache=not args.no_cache,
+                                  rebuild_cache=args.rebuild_cache, headless=args.headless, threads=args.threads,
+                                  max_view_error=args.max_view_error, pyramid=args.pyramid,
+                                  min_sharpness=args.min_sharpness, check_side=args.check_size,
+                                  max_views=args.max_views, compare_views=args.compare_views, frame_cache=args.frame_cache * 1000000,
+                                  crop=tuple(map(int, args.crop.split(","))) if args.crop else None, bootstrap=args.bootstrap)
+    try:
+        calibrator.check_board_dimensions()
+    except ValueError as e:
+        print(e)
+        exit(1)
+    if args.bench:
+        calibrator.benchmark_workers(args.workers if args.workers > 1 else None)
+        exit()
+    calibrator.run_calibration()
+    calibrator.save_calib_params()
+    calibrator.undistort_images_save()
+
+
+if __name__ == "__main__":
+    main()
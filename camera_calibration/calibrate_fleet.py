@@ -0,0 +1,160 @@
+######## Fleet calibration for many RPI IR-Cut cameras #########
+
+# Author: Petros626
+# Description:
+# calibrate_camera.py calibrates one image folder and always writes calibrate_camera.json to the
+# working directory. This program calibrates the image sets of many cameras in a pool of processes:
+# the sets are given by a manifest (JSON list of {"name", "imgdir", "board"}) or by a parent folder
+# with one sub folder per camera. Every camera gets its own folder with the calibration file, the
+# binary bundle and the log of the calibration. A failing camera is reported in the summary, the
+# other cameras are calibrated anyway. The summary table is printed and saved as JSON.
+
+# Example usage to calibrate all sub folders of fleet_images with 4 processes:
+# python3 -m camera_calibration fleet --parent=fleet_images --outdir=fleet_results --workers=4
+# Example usage with a manifest:
+# python3 -m camera_calibration fleet --manifest=cameras.json --outdir=fleet_results
+
+from os import path, makedirs, listdir, cpu_count
+from argparse import ArgumentParser
+from json import load, dump
+from time import perf_counter, strftime
+from contextlib import redirect_stdout
+from traceback import format_exc
+from concurrent.futures import ProcessPoolExecutor
+from sys import exit
+from .calibrate_camera import CameraCalibrator, init_detect_worker
+
+
+# Function to read the camera sets of a manifest, relative image folders are relative to the manifest
+def read_manifest(filename, board="9x6"):
+    with open(filename, "r") as f:
+        entries = load(f)
+    base = path.dirname(path.abspath(filename))
+    cameras = []
+    for entry in entries:
+        imgdir = path.join(base, entry["imgdir"])
+        cameras.append({"name": entry.get("name", path.basename(path.normpath(imgdir))), "imgdir": imgdir,
+                        "board": entry.get("board", board)})
+    return cameras
+
+
+# Function to get one camera set per sub folder of the parent folder
+def scan_parent(parent, board="9x6"):
+    return [{"name": name, "imgdir": path.join(parent, name), "board": board}
+            for name in sorted(listdir(parent)) if path.isdir(path.join(parent, name))]
+
+
+# Function to calibrate the images of one camera, runs in a worker process. The output of the
+# calibration goes to the log file of the camera, errors are returned instead of raised.
+def calibrate_set(camera, outdir, options):
+    camera_dir = path.join(outdir, camera["name"])
+    if not path.exists(camera_dir):
+        makedirs(camera_dir)
+    result = {"name": camera["name"], "imgdir": camera["imgdir"], "status": "ok", "error": None}
+    start = perf_counter()
+    with open(path.join(camera_dir, "calibration.log"), "w") as log, redirect_stdout(log):
+        try:
+            calibrator = CameraCalibrator(camera["imgdir"], camera_dir, camera["board"], headless=True, **options)
+            calibrator.filename = path.join(camera_dir, "calibrate_camera.json")
+            detect_start = perf_counter()
+            calibrator.find_draw_corners()
+            result["detect_s"] = perf_counter() - detect_start
+            if len(calibrator.objpoints) < 3:
+                raise ValueError("only {} views with a board found".format(len(calibrator.objpoints)))
+            calibrate_start = perf_counter()
+            calibrator.calibrate()
+            calibrator.compute_reprojection_errors()
+            if calibrator.max_view_error is not None:
+                calibrator.reject_outliers()
+            result["calibrate_s"] = perf_counter() - calibrate_start
+            calibrator.save_calib_params()
+            result.update({"images": len(calibrator.images), "views": len(calibrator.objpoints), "rms": float(calibrator.ret),
+                           "mean_error": float(calibrator.mean_error), "size": list(calibrator.img_size),
+                           "calibration": calibrator.filename})
+        except Exception as e:
+            print(format_exc())
+            result.update({"status": "failed", "error": "{}: {}".format(type(e).__name__, e)})
+    result["total_s"] = perf_counter() - start
+    return result
+
+
+# Function to calibrate all cameras in a pool of processes, a crashed worker only fails its camera
+def calibrate_fleet(cameras, outdir, workers=None, options=None):
+    options = options or {}
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_detect_worker) as pool:
+        futures = [(camera, pool.submit(calibrate_set, camera, outdir, options)) for camera in cameras]
+        for camera, future in futures:
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {"name": camera["name"], "imgdir": camera["imgdir"], "status": "failed",
+                          "error": "{}: {}".format(type(e).__name__, e)}
+            print("{} -> {}{}".format(result["name"], result["status"], "" if result["error"] is None else " ({})".format(result["error"])))
+            results.append(result)
+    return results
+
+
+# Function to print the summary table of all cameras
+def print_summary(results, elapsed):
+    print("\n{:<20} | {:>6} | {:>6} | {:>8} | {:>10} | {:>10} | {:>9} | {}".format(
+        "camera", "images", "views", "RMS [px]", "mean error", "detect [s]", "solve [s]", "status"))
+    for result in results:
+        if result["status"] == "ok":
+            print("{:<20} | {:>6} | {:>6} | {:>8.4f} | {:>10.5f} | {:>10.2f} | {:>9.2f} | ok".format(
+                result["name"], result["images"], result["views"], result["rms"], result["mean_error"],
+                result["detect_s"], result["calibrate_s"]))
+        else:
+            print("{:<20} | {:>6} | {:>6} | {:>8} | {:>10} | {:>10} | {:>9} | {}".format(
+                result["name"], "-", "-", "-", "-", "-", "-", result["error"]))
+    failed = sum(1 for result in results if result["status"] != "ok")
+    print("\n{} cameras calibrated, {} failed in {:.2f} s.".format(len(results) - failed, failed, elapsed))
+
+
+# Function to run the command line interface
+def main(argv=None):
+    parser = ArgumentParser()
+    parser.add_argument("--manifest", help = "JSON file with a list of camera sets {\"name\", \"imgdir\", \"board\"}.",
+                        default = None)
+    parser.add_argument("--parent", help = "Folder with one sub folder of calibration images per camera.",
+                        default = None)
+    parser.add_argument("--outdir", help = "Folder for the results, every camera gets a sub folder.",
+                        default = "fleet_results")
+    parser.add_argument("--board", help = "Dimensions of the checkerboard, if the manifest doesn't give them.",
+                        default = "9x6")
+    parser.add_argument("--workers", type=int, help = "Number of cameras calibrated at once.",
+                        default = cpu_count() or 1)
+    parser.add_argument("--no-cache", action="store_true", help = "Don't read or write the corner caches in the image folders.")
+    parser.add_argument("--max-view-error", type=float, help = "Drop views with a higher re-projection RMS in px and recalibrate.",
+                        default = None)
+    parser.add_argument("--pyramid", type=int, help = "Search the board on a copy downscaled to this size of the longer side (0 = off).",
+                        default = 0)
+    args = parser.parse_args(argv)
+
+    if (args.manifest is None) == (args.parent is None):
+        print("Specify either --manifest or --parent.")
+        exit()
+    cameras = read_manifest(args.manifest, args.board) if args.manifest else scan_parent(args.parent, args.board)
+    if not cameras:
+        print("No camera sets found.")
+        exit()
+    if not path.exists(args.outdir):
+        makedirs(args.outdir)
+
+    print("Calibrate {} cameras with {} processes...".format(len(cameras), args.workers))
+    options = {"use_cache": not args.no_cache, "max_view_error": args.max_view_error, "pyramid": args.pyramid}
+    start = perf_counter()
+    results = calibrate_fleet(cameras, args.outdir, args.workers, options)
+    elapsed = perf_counter() - start
+    print_summary(results, elapsed)
+
+    summary_file = path.join(args.outdir, "summary.json")
+    with open(summary_file, "w") as f:
+        dump({"date": strftime("%Y-%m-%d %H:%M:%S"), "elapsed_s": elapsed, "cameras": results}, f, indent=4)
+    print("Save the summary to -> {}.".format(summary_file))
+    if any(result["status"] != "ok" for result in results):
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
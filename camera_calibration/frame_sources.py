@@ -0,0 +1,207 @@
+######## Frame sources for the live undistortion tools #########
+
+# Author: Petros626
+# Description:
+# The live tools were hard-wired to Picamera2, libcamera and the keyboard module, so the per-frame
+# path could only run on a Pi with the IR-Cut camera attached. This module gives them a pluggable
+# frame source: the Picamera2 camera or a replay of a directory of images (e.g. opencv_data) or of
+# a video file at a target FPS. All sources deliver XRGB frames (h, w, 4) like the camera does, so
+# the undistort/display/save loop runs unchanged. The key inputs are pluggable as well, so the loop
+# can run headless. Picamera2, libcamera and keyboard are only imported when they are used.
+
+# Example usage to replay the bundled images headless at 30 FPS:
+# python3 -m camera_calibration take --source=camera_calibration/opencv_data --fps=30 --headless
+
+from contextlib import contextmanager
+from glob import glob
+from os import path
+from sys import stdin
+from time import perf_counter, sleep
+from cv2 import imread, cvtColor, COLOR_BGR2BGRA, VideoCapture, CAP_PROP_POS_FRAMES
+
+
+# Define FrameSource class, the interface of all frame sources
+class FrameSource():
+    # Constructor with instance attributes
+    def __init__(self):
+        self.size = None
+        # Sensor crop (x, y, w, h) in sensor pixels, None if unknown (replayed frames)
+        self.crop = None
+        # Sensor timestamp in s of the last mapped frame, None if the source has none (replayed frames)
+        self.timestamp = None
+
+    # Function to start the source
+    def start(self):
+        pass
+
+    # Function to get the next XRGB frame, None at the end of the source
+    def capture(self):
+        raise NotImplementedError
+
+    # Function to access the next frame without copies, the frame is only valid inside the with block
+    @contextmanager
+    def mapped(self):
+        yield self.capture()
+
+    # Function to stop the source
+    def close(self):
+        pass
+
+
+# Define PicameraSource class for the RPi IR-Cut camera
+class PicameraSource(FrameSource):
+    # Constructor with instance attributes
+    def __init__(self, size, tuning="ov5647_custom.json"):
+        super().__init__()
+        from picamera2 import Picamera2, MappedArray
+        from libcamera import controls
+        self.MappedArray = MappedArray
+        self.size = tuple(size)
+        # Load the tuning for the RPi IR-Cut camera.
+        # Renamed the original file (ov5647.json) to custom.
+        tuning_file = Picamera2.load_tuning_file(tuning)
+        # Call picamera2 constructor and pass loaded tuning file.
+        self.picam2 = Picamera2(tuning=tuning_file)
+        # Set options for saving images
+        self.picam2.options["quality"] = 95 # best quality
+        self.picam2.options["compress_level"] = 0 # no compression
+        # Create preview configuration with denoising
+        self.picam2.configure(self.picam2.create_preview_configuration(main={"format": "XRGB8888", "size": self.size}, controls={"NoiseReductionMode":controls.draft.NoiseReductionModeEnum.HighQuality}))
+
+    # The sensor crop of the mode is known once the camera runs
+    def start(self):
+        self.picam2.start()
+        self.crop = tuple(self.picam2.capture_metadata()["ScalerCrop"])
+
+    def capture(self):
+        return self.picam2.capture_array("main")
+
+    # The request is released right after the with block
+    @contextmanager
+    def mapped(self):
+        request = self.picam2.capture_request()
+        try:
+            self.timestamp = request.get_metadata()["SensorTimestamp"] / 1e9
+            with self.MappedArray(request, "main") as m:
+                yield m.array
+        finally:
+            request.release()
+
+    def close(self):
+        self.picam2.stop()
+        self.picam2.close()
+
+
+# Define ReplaySource class, the base of the sources which replay recorded frames at a target FPS
+class ReplaySource(FrameSource):
+    # Constructor with instance attributes
+    def __init__(self, fps=0, loop=False):
+        super().__init__()
+        self.fps = fps
+        self.loop = loop
+        self.next_time = None
+
+    # Function to wait until the next frame is due (fps=0 replays as fast as possible)
+    def pace(self):
+        if not self.fps:
+            return
+        now = perf_counter()
+        if self.next_time is None:
+            self.next_time = now
+        if self.next_time > now:
+            sleep(self.next_time - now)
+        # Don't try to catch up, if the consumer was slower than the target FPS
+        self.next_time = max(self.next_time, now) + 1.0 / self.fps
+
+
+# Define ImageDirSource class to replay a directory of images in sorted order
+class ImageDirSource(ReplaySource):
+    # Constructor with instance attributes
+    def __init__(self, dirname, fps=0, loop=False, patterns=("*.png", "*.jpg")):
+        super().__init__(fps, loop)
+        self.images = sorted(fname for pattern in patterns for fname in glob(path.join(dirname, pattern)))
+        if not self.images:
+            raise ValueError("No images found in '{}'.".format(dirname))
+        self.index = 0
+        h, w = imread(self.images[0]).shape[:2]
+        self.size = (w, h)
+
+    def capture(self):
+        if self.index >= len(self.images):
+            if not self.loop:
+                return None
+            self.index = 0
+        self.pace()
+        frame = imread(self.images[self.index])
+        self.index += 1
+        return cvtColor(frame, COLOR_BGR2BGRA)
+
+
+# Define VideoSource class to replay a video file
+class VideoSource(ReplaySource):
+    # Constructor with instance attributes
+    def __init__(self, filename, fps=0, loop=False):
+        super().__init__(fps, loop)
+        self.video = VideoCapture(filename)
+        if not self.video.isOpened():
+            raise ValueError("Video '{}' can't be opened.".format(filename))
+        ret, frame = self.video.read()
+        if not ret:
+            raise ValueError("Video '{}' has no frames.".format(filename))
+        self.size = (frame.shape[1], frame.shape[0])
+        self.video.set(CAP_PROP_POS_FRAMES, 0)
+
+    def capture(self):
+        ret, frame = self.video.read()
+        if not ret and self.loop:
+            self.video.set(CAP_PROP_POS_FRAMES, 0)
+            ret, frame = self.video.read()
+        if not ret:
+            return None
+        self.pace()
+        return cvtColor(frame, COLOR_BGR2BGRA)
+
+    def close(self):
+        self.video.release()
+
+
+# Function to open a source: "camera", a directory of images or a video file
+def open_source(name, size=(1920, 1080), fps=0, loop=False):
+    if name == "camera":
+        return PicameraSource(size)
+    if path.isdir(name):
+        return ImageDirSource(name, fps, loop)
+    if path.isfile(name):
+        return VideoSource(name, fps, loop)
+    raise ValueError("Unknown frame source '{}' (use camera, a directory or a video file).".format(name))
+
+
+# Define KeyboardInput class for the keys pressed on the Pi
+class KeyboardInput():
+    # Constructor with instance attributes
+    def __init__(self):
+        from keyboard import is_pressed
+        self.is_pressed = is_pressed
+
+    # Function to flush the pressed keys from the terminal
+    def close(self):
+        from termios import tcflush, TCIOFLUSH
+        if stdin.isatty():
+            tcflush(stdin, TCIOFLUSH)
+
+
+# Define ScriptedInput class for headless runs, 'p' is pressed every save_every frames (0 = never)
+class ScriptedInput():
+    # Constructor with instance attributes
+    def __init__(self, save_every=0):
+        self.save_every = save_every
+        self.polls = 0
+
+    def is_pressed(self, key):
+        if key != "p" or not self.save_every:
+            return False
+        self.polls += 1
+        return self.polls % self.save_every == 0
+
+    def close(self):
+        pass
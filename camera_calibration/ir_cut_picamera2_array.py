@@ -10,132 +10,291 @@
 # implemented.
 
 # Example usage to save images in a directory named images at 1920x1080 resolution:
-# python3 run_camera_config.py --imgdir=images --res=1920x1080
+# python3 -m camera_calibration take --imgdir=images --res=1920x1080
+# Example usage to replay the bundled images without camera and window:
+# python3 -m camera_calibration take --source=camera_calibration/opencv_data --fps=30 --headless
 
 # This code is based off the Picamera2 library examples at:
 # https://github.com/raspberrypi/picamera2/tree/a9f7a7d0bac726ab9b3f366ff461ddd62e885f40/examples
 # https://docs.opencv.org/4.x/dc/dbb/tutorial_py_calibration.html
 # https://betterprogramming.pub/how-to-calibrate-a-camera-using-python-and-opencv-23bab86ca194
 
-from picamera2 import Picamera2
 from os import getcwd, path, makedirs
 from argparse import ArgumentParser
-from keyboard import is_pressed
-from termios import tcflush, TCIOFLUSH
-from sys import stdin, exit
-from libcamera import controls
-from json import load
-from numpy import array, float64
+from sys import exit
+from time import perf_counter
 from cv2 import (
-    cvtColor, imwrite, COLOR_RGBA2RGB, undistort, imshow, getOptimalNewCameraMatrix, waitKey, destroyAllWindows,
+    cvtColor, COLOR_RGBA2RGB, imshow, destroyAllWindows,
     namedWindow, WINDOW_NORMAL, startWindowThread, resizeWindow, moveWindow
 )
+from numpy import empty, uint8
+from collections import deque
+from .undistort_maps import undistort_frame
+from .calib_bundle import load_maps
+from .live_pipeline import run_pipeline, SnapshotWriter, measure_allocations
+from .frame_sources import open_source, KeyboardInput, ScriptedInput
 
-#### Parser and safety requests #####
-# Fetch script arguments
-parser = ArgumentParser()
-parser.add_argument("--imgdir", help = "Folder where the taken images get saved. If you not specify there will be created one automatically.",
-                    default = "images")
-parser.add_argument("--res", help = "Required resolution in WxH. To avoid erros find out about the supported resolutions of your camera model.",
-                       default = "1920x1080")
-
-args = parser.parse_args()
-dirname = args.imgdir
-
-# Check if resolution is specified correctly
-if not "x" in args.res:
-    print("Specify resolution with x as WxH. (Example: 1920x1080).")
-    exit()
-imgW, imgH = map(int, args.res.split("x"))
-
-# Create a folder, if it doesn't exist
-cwd = getcwd()
-dirpath = path.join(cwd,dirname)
-if not path.exists(dirpath):
-    makedirs(dirpath)
-    
-# Prevent taken frame overwriting
-imgnum  = 1
-key_flag = False
-
-while 1:
-    filename = f"{dirname}_{imgnum}.png"
-    if not path.exists(path.join(dirpath, filename)):
-        break
-    imgnum +=1
-
-#### Initialize camera #####
-# Load the tuning for the RPi IR-Cut camera.
-# Renamed the original file (ov5647.json) to custom.
-tuning_file = Picamera2.load_tuning_file("ov5647_custom.json")
-# Call picamera2 constructor and pass loaded tuning file.
-picam2 = Picamera2(tuning=tuning_file)
-# Set options for saving images
-picam2.options["quality"] = 95 # best quality
-picam2.options["compress_level"] = 0 # no compression
-
-# Print the hints for the user
-print("\n##############################")
-print("### Image taker calibrated ###")
-print("##############################")
-print("For help run the script with the '--help' option.")
-print("\nPress 'p' to take an image, they will be saved in the '{}' folder.".format(dirname))
-print("To quit the application press 'q'.\n")
-
-# Create preview configuration with denoising
-picam2.configure(picam2.create_preview_configuration(main={"format": "XRGB8888", "size": (1920, 1080)}, controls={"NoiseReductionMode":controls.draft.NoiseReductionModeEnum.HighQuality}))
-picam2.start()
-
-# Setup the preview Window with OpenCV (PiCamera2 not compatible)
-# Set size, position and window size
-winname = "Calibrated (undistorted) Image taker"
-namedWindow(winname, WINDOW_NORMAL)
-resizeWindow(winname, 1000, 900)
-moveWindow(winname, 915, 72)
-startWindowThread()
-
-# Load the calibration file with params
-with open("calibrate_camera.json", "r") as f:
-    calibration_file = load(f)
-mtx = array(calibration_file["mtx"], dtype=float64)
-dist = array(calibration_file["dist"], dtype=float64)
-
-try:
-    while 1:
-            # request - faster?
-            #request = picam2.capture_request()
-            #array = request.make_array("main")
-            
-            #2 direct capture -faster ?
-            array = picam2.capture_array("main")
-            new_cv_img = cvtColor(array, COLOR_RGBA2RGB)
-            h, w = new_cv_img.shape[:2]
-            optimal_camera_matrix, roi = getOptimalNewCameraMatrix(mtx, dist, (w, h), 0, (w, h))
-            dst = undistort(new_cv_img, mtx, dist, None, optimal_camera_matrix)
-            # hold the default image size (not cropping)
-            #x, y, w, h = roi
-            #dst = dst[y:y+h, x:x+w]
-            
-            imshow(winname, dst)
-       
-            if is_pressed("p"):
-                if key_flag is False:
-                    key_flag = True
-                    filename = "".join([dirname, "_", str(imgnum), ".png"])
-                    savepath = path.join(dirpath, filename)
-                    imwrite(savepath, dst)
-                    print("\rOpenCV image saved from request -> {}".format(filename))
-                    imgnum+=1
+
+# Define ImageTaker class to preview the undistorted frames of a source and to save snapshots
+class ImageTaker():
+    # Constructor with instance attributes, the source is started with start()
+    def __init__(self, source, keys, writer, calib="calibrate_camera.json", alpha=0, headless=False, pipeline=False,
+                 preview=False, preview_size=(1000, 900), zero_copy=False):
+        self.source = source
+        self.keys = keys
+        self.writer = writer
+        self.calib = calib
+        self.alpha = alpha
+        self.headless = headless
+        self.pipeline = pipeline
+        self.preview = preview
+        self.preview_size = tuple(preview_size)
+        self.zero_copy = zero_copy
+        self.winname = "Calibrated (undistorted) Image taker"
+        # Prevent taken frame overwriting, the writer picks the next free file name
+        self.key_flag = False
+        self.save_requested = False
+        self.dst = None
+        self.free_buffers = deque()
+        self.buffer_shape = None
+        self.allocated_buffers = 0
+        self.displayed = 0
+        self.map1 = self.map2 = self.map1_preview = self.map2_preview = None
+        self.roi = None
+
+    # Function to start the source, to open the window and to load the maps
+    def start(self):
+        # Start the source, a replayed source has the size of the recorded frames (--res only sets the camera mode)
+        self.source.start()
+        size = self.source.size
+
+        # Setup the preview Window with OpenCV (PiCamera2 not compatible)
+        # Set size, position and window size
+        if not self.headless:
+            namedWindow(self.winname, WINDOW_NORMAL)
+            resizeWindow(self.winname, self.preview_size[0], self.preview_size[1])
+            moveWindow(self.winname, 915, 72)
+            startWindowThread()
+
+        # Map the calibration bundle with params and undistortion maps (built once from the calibration file).
+        # For another resolution or sensor crop than the calibration the camera matrix is derived and the
+        # maps of this mode are added to the bundle.
+        _, _, self.map1, self.map2, _, self.roi = load_maps(self.calib, size, self.alpha, crop=self.source.crop)
+        if self.preview:
+            _, _, self.map1_preview, self.map2_preview, _, _ = load_maps(self.calib, size, self.alpha, self.preview_size, self.source.crop)
+        # Size of the shown frames, with --preview the maps produce the window size directly
+        out_size = self.preview_size if self.preview else size
+        # Pool of preallocated XRGB output buffers for the zero-copy path. A buffer only returns to the
+        # pool after it was displayed, because the capture thread of the pipeline may run far ahead of a
+        # slow display. With the pipeline up to 5 frames are in use at once: capture, two queues (of 1),
+        # the process worker and the display. Frames dropped by the queues return to the pool as well.
+        self.buffer_shape = (out_size[1], out_size[0], 4)
+        self.free_buffers = deque(self.new_buffer() for _ in range(5))
+
+    # Function to capture a frame from the camera
+    def capture(self):
+        # request - faster?
+        #request = picam2.capture_request()
+        #array = request.make_array("main")
+        
+        #2 direct capture -faster ?
+        return self.source.capture()
+
+    # Function to allocate an output buffer for the zero-copy path
+    def new_buffer(self):
+        self.allocated_buffers += 1
+        return empty(self.buffer_shape, dtype=uint8)
+
+    # Function to return a displayed frame of the zero-copy path to the pool of buffers
+    def release(self, frame):
+        if self.zero_copy and frame is not None:
+            self.free_buffers.append(frame)
+
+    # Function to capture and undistort a frame without copies. The XRGB8888 data is remapped
+    # straight out of the request buffer (all 4 channels) and the request is released right after.
+    def capture_zero_copy(self):
+        out = self.free_buffers.popleft() if self.free_buffers else self.new_buffer()
+        with self.source.mapped() as raw:
+            if raw is None:
+                self.free_buffers.append(out)
+                return None
+            if self.preview:
+                self.undistort_preview(raw, out)
+            else:
+                undistort_frame(raw, self.map1, self.map2, out)
+        return out
+
+    # Function to undistort and downscale the XRGB frame to the window size in one remap.
+    # Only a frame requested with 'p' is also undistorted in full resolution and saved.
+    def undistort_preview(self, raw, out=None):
+        if self.save_requested:
+            self.save_requested = False
+            self.writer.save(undistort_frame(raw, self.map1, self.map2)[:, :, :3])
+        return undistort_frame(raw, self.map1_preview, self.map2_preview, out)
+
+    # Function to drop the X channel and undistort the frame
+    def process(self, array):
+        if array is None:
+            return None
+        if self.preview:
+            self.dst = self.undistort_preview(array, None if self.pipeline else self.dst)
+            return self.dst
+        new_cv_img = cvtColor(array, COLOR_RGBA2RGB)
+        # Remap with the precomputed maps, the output buffer is only reused in the serial loop,
+        # because in the pipeline the display stage may still show the previous frame
+        self.dst = undistort_frame(new_cv_img, self.map1, self.map2, None if self.pipeline else self.dst)
+        # hold the default image size (not cropping)
+        #x, y, w, h = self.roi
+        #self.dst = self.dst[y:y+h, x:x+w]
+        return self.dst
+
+    # Function to show the frame and handle the keys, returns False to stop. The buffer of the frame
+    # can be reused afterwards (a snapshot is copied by the writer).
+    def display(self, frame):
+        try:
+            return self.show(frame)
+        finally:
+            self.release(frame)
+
+    # Function to show the frame and handle the keys
+    def show(self, frame):
+        if frame is None:
+            print("\rEnd of the frame source.")
+            return False
+        self.displayed += 1
+        if not self.headless:
+            imshow(self.winname, frame)
+        
+        if self.keys.is_pressed("p"):
+            if self.key_flag is False:
+                self.key_flag = True
+                if self.preview:
+                    # The next frame is undistorted in full resolution and saved
+                    self.save_requested = True
                 else:
-                    key_flag = False
-            #request.release() 
-            elif is_pressed("q"):
-                print("\r++++++++++++++++++++++++++++++++++++++++++++++")
-                print("\rInterruption: stop preview and close camera...")
-                break 
-     
-finally:
-    destroyAllWindows()
-    picam2.stop()
-    picam2.close()
-    tcflush(stdin, TCIOFLUSH)
\ No newline at end of file
+                    # Encoding and saving runs on the background writer, the X channel is dropped
+                    self.writer.save(frame[:, :, :3])
+            else:
+                self.key_flag = False
+        #request.release() 
+        elif self.keys.is_pressed("q"):
+            print("\r++++++++++++++++++++++++++++++++++++++++++++++")
+            print("\rInterruption: stop preview and close camera...")
+            return False
+        return True
+
+    # Function to run the preview loop until 'q' or the end of the source, returns the FPS
+    def run(self, measure_alloc=0):
+        if self.zero_copy:
+            # The undistortion already happens while the request buffer is mapped
+            capture_frame, process_frame = self.capture_zero_copy, lambda frame: frame
+        else:
+            capture_frame, process_frame = self.capture, self.process
+        
+        if measure_alloc > 0:
+            allocated = measure_allocations(lambda: self.release(process_frame(capture_frame())), measure_alloc)
+            print("\rAllocated per frame ({}): {:.2f} MB".format("zero-copy" if self.zero_copy else "capture_array", allocated / 1e6))
+        
+        start = perf_counter()
+        if self.pipeline:
+            # Capture, undistortion and display run concurrently, late frames are dropped
+            run_pipeline(capture_frame, process_frame, self.display, release=self.release)
+        else:
+            while self.display(process_frame(capture_frame())):
+                pass
+        elapsed = perf_counter() - start
+        print("\r{} frames in {:.2f} s ({:.1f} FPS).".format(self.displayed, elapsed, self.displayed / elapsed))
+        if self.zero_copy:
+            print("\r{} output buffers allocated.".format(self.allocated_buffers))
+        return self.displayed / elapsed
+
+    # Function to stop the writer, the window, the source and the keys
+    def close(self):
+        self.writer.close()
+        if not self.headless:
+            destroyAllWindows()
+        self.source.close()
+        self.keys.close()
+
+
+# Function to run the command line interface
+def main(argv=None):
+    #### Parser and safety requests #####
+    # Fetch script arguments
+    parser = ArgumentParser()
+    parser.add_argument("--imgdir", help = "Folder where the taken images get saved. If you not specify there will be created one automatically.",
+                        default = "images")
+    parser.add_argument("--res", help = "Required resolution in WxH. To avoid erros find out about the supported resolutions of your camera model.",
+                           default = "1920x1080")
+    parser.add_argument("--alpha", type=float, help = "Free scaling parameter of the optimal camera matrix (0 = only valid pixels, 1 = all pixels).",
+                           default = 0)
+    parser.add_argument("--source", help = "Frame source: 'camera', a directory of images or a video file to replay.",
+                           default = "camera")
+    parser.add_argument("--fps", type=float, help = "Target FPS of a replayed source (0 = as fast as possible).",
+                           default = 0)
+    parser.add_argument("--loop", action="store_true", help = "Repeat a replayed source endlessly.")
+    parser.add_argument("--headless", action="store_true", help = "Run without preview window and keyboard, the loop stops at the end of a replayed source.")
+    parser.add_argument("--save-every", type=int, help = "Headless only: press 'p' every N frames.",
+                           default = 0)
+    parser.add_argument("--pipeline", action="store_true", help = "Run capture, undistortion and display on separate threads, late frames are dropped. Prints FPS and latency per stage.")
+    parser.add_argument("--preview", action="store_true", help = "Undistort straight to the window size in one remap, only saved frames are undistorted in full resolution.")
+    parser.add_argument("--preview-size", help = "Size of the preview window in WxH.",
+                           default = "1000x900")
+    parser.add_argument("--zero-copy", action="store_true", help = "Remap straight out of the camera request buffer into preallocated output buffers.")
+    parser.add_argument("--measure-alloc", type=int, help = "Measure the allocated bytes per frame over the given number of frames before the preview starts.",
+                           default = 0)
+    parser.add_argument("--format", help = "File format of the taken images (png or jpg).",
+                           default = "png")
+    parser.add_argument("--compression", type=int, help = "PNG compression level 0-9 (0 = no compression, fastest).",
+                           default = 0)
+    parser.add_argument("--quality", type=int, help = "JPEG quality 0-100.",
+                           default = 95)
+    parser.add_argument("--calib", help = "Calibration file with the camera parameters.",
+                           default = "calibrate_camera.json")
+    parser.add_argument("--queue", type=int, help = "Number of snapshots that may wait for the background writer.",
+                           default = 8)
+
+    args = parser.parse_args(argv)
+    dirname = args.imgdir
+
+    # Check if resolution is specified correctly
+    if not "x" in args.res:
+        print("Specify resolution with x as WxH. (Example: 1920x1080).")
+        exit()
+    imgW, imgH = map(int, args.res.split("x"))
+    if not "x" in args.preview_size:
+        print("Specify preview size with x as WxH. (Example: 1000x900).")
+        exit()
+    preview_size = tuple(map(int, args.preview_size.split("x")))
+
+    # Create a folder, if it doesn't exist
+    cwd = getcwd()
+    dirpath = path.join(cwd,dirname)
+    if not path.exists(dirpath):
+        makedirs(dirpath)
+    writer = SnapshotWriter(dirpath, dirname, args.format, args.compression, args.quality, args.queue)
+
+    #### Initialize camera #####
+    # The camera (or a replay of recorded frames) delivers the XRGB frames
+    source = open_source(args.source, (imgW, imgH), args.fps, args.loop)
+    keys = ScriptedInput(args.save_every) if args.headless else KeyboardInput()
+    taker = ImageTaker(source, keys, writer, args.calib, args.alpha, args.headless, args.pipeline, args.preview,
+                       preview_size, args.zero_copy)
+
+    # Print the hints for the user
+    print("\n##############################")
+    print("### Image taker calibrated ###")
+    print("##############################")
+    print("For help run the script with the '--help' option.")
+    print("\nPress 'p' to take an image, they will be saved in the '{}' folder.".format(dirname))
+    print("To quit the application press 'q'.\n")
+
+    try:
+        taker.start()
+        taker.run(args.measure_alloc)
+    finally:
+        taker.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+######## Threaded live pipeline for the RPI IR-Cut camera #########
+
+# Author: Petros626
+# Description:
+# In the serial loop the slowest stage (capture, undistortion or display) sets the frame rate
+# and the stages wait for each other. This module runs capture and processing on their own threads
+# and displays on the calling (main) thread, because HighGUI needs it. The stages are connected by
+# bounded queues with a latest-frame-wins policy: if a stage is too slow, the oldest waiting frame
+# is dropped instead of building up latency. The live FPS and the latency per stage are reported.
+# Snapshots are handed to a background writer, so encoding and saving never stalls the preview.
+
+from threading import Thread, Event
+from queue import Queue, Full, Empty
+from collections import defaultdict
+from time import perf_counter
+from os import path
+from tracemalloc import start as trace_start, stop as trace_stop, reset_peak, get_traced_memory
+from cv2 import imwrite, IMWRITE_PNG_COMPRESSION, IMWRITE_JPEG_QUALITY
+
+
+# Define LatestQueue class, a bounded queue which drops the oldest item when it is full. A dropped
+# item is handed to on_drop, e.g. to reuse its buffer.
+class LatestQueue():
+    # Constructor with instance attributes
+    def __init__(self, maxsize=1, on_drop=None):
+        self.queue = Queue(maxsize)
+        self.dropped = 0
+        self.on_drop = on_drop
+
+    # Function to add an item, the oldest waiting item is dropped if the queue is full
+    def put(self, item):
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return
+            except Full:
+                try:
+                    dropped = self.queue.get_nowait()
+                    self.dropped += 1
+                except Empty:
+                    continue
+                if self.on_drop is not None:
+                    self.on_drop(dropped)
+
+    # Function to get the next item, raises queue.Empty after the timeout
+    def get(self, timeout=None):
+        return self.queue.get(timeout=timeout)
+
+
+# Define PipelineStats class to collect the stage timings and to report them periodically
+class PipelineStats():
+    # Constructor with instance attributes
+    def __init__(self, interval=2.0):
+        self.interval = interval
+        self.durations = defaultdict(list)
+        self.frames = 0
+        self.last_report = perf_counter()
+
+    # Function to add the duration of a stage in seconds
+    def add(self, stage, seconds):
+        self.durations[stage].append(seconds)
+
+    # Function to count a displayed frame and print the statistics once per interval
+    def frame_done(self, dropped=0):
+        self.frames += 1
+        now = perf_counter()
+        if now - self.last_report < self.interval:
+            return None
+        fps = self.frames / (now - self.last_report)
+        means = {stage: 1000 * sum(values) / len(values) for stage, values in self.durations.items() if values}
+        stages = " | ".join("{} {:.1f} ms".format(stage, ms) for stage, ms in means.items())
+        print("\rFPS: {:.1f} | {} | dropped: {}".format(fps, stages, dropped))
+        self.durations.clear()
+        self.frames = 0
+        self.last_report = now
+        return fps, means
+
+
+# Define SnapshotWriter class to save snapshots on a background thread with a bounded queue
+class SnapshotWriter():
+    # Constructor with instance attributes
+    def __init__(self, dirpath, prefix, ext="png", compression=0, quality=95, maxsize=8):
+        self.dirpath = dirpath
+        self.prefix = prefix
+        self.ext = ext.lstrip(".").lower()
+        if self.ext == "png":
+            self.params = [IMWRITE_PNG_COMPRESSION, compression]
+        elif self.ext in ("jpg", "jpeg"):
+            self.params = [IMWRITE_JPEG_QUALITY, quality]
+        else:
+            self.params = []
+        self.queue = Queue(maxsize)
+        self.imgnum = 1
+        self.skipped = 0
+        self.thread = Thread(target=self.worker, daemon=True)
+        self.thread.start()
+
+    # Function to get the next free file name, so taken frames are never overwritten
+    def next_filename(self):
+        while 1:
+            filename = "{}_{}.{}".format(self.prefix, self.imgnum, self.ext)
+            self.imgnum += 1
+            if not path.exists(path.join(self.dirpath, filename)):
+                return filename
+
+    # Function to queue a copy of the frame, returns the file name or None if the writer is busy
+    def save(self, frame):
+        if self.queue.full():
+            self.skipped += 1
+            print("\rWriter busy ({} snapshots queued): snapshot skipped, {} skipped so far.".format(self.queue.qsize(), self.skipped))
+            return None
+        filename = self.next_filename()
+        # Copy the frame, because the capture loop reuses its buffer
+        self.queue.put((filename, frame.copy()))
+        if self.queue.qsize() > 1:
+            print("\rWriter behind: {} snapshots queued.".format(self.queue.qsize()))
+        return filename
+
+    # Function of the background thread which encodes and saves the queued frames
+    def worker(self):
+        while 1:
+            item = self.queue.get()
+            if item is None:
+                break
+            filename, frame = item
+            start = perf_counter()
+            imwrite(path.join(self.dirpath, filename), frame, self.params)
+            print("\rOpenCV image saved from request -> {} ({:.0f} ms)".format(filename, (perf_counter() - start) * 1000))
+
+    # Function to save all queued snapshots and stop the writer
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+# Function to measure the bytes allocated per frame (peak of the traced memory) while step() runs
+def measure_allocations(step, frames=100):
+    trace_start()
+    sizes = []
+    try:
+        for _ in range(frames):
+            reset_peak()
+            current = get_traced_memory()[0]
+            step()
+            sizes.append(get_traced_memory()[1] - current)
+    finally:
+        trace_stop()
+    return sum(sizes) / len(sizes)
+
+
+# Function to run capture() -> process(frame) -> display(frame) as pipeline. capture and process run
+# on worker threads, display runs on the calling thread and returns False to stop the pipeline.
+# Frames dropped by the queues are handed to release(frame), if given.
+def run_pipeline(capture, process, display, queue_size=1, interval=2.0, release=None):
+    stop = Event()
+    on_drop = None if release is None else lambda item: release(item[0])
+    captured, processed = LatestQueue(queue_size, on_drop), LatestQueue(queue_size, on_drop)
+    stats = PipelineStats(interval)
+
+    def capture_worker():
+        while not stop.is_set():
+            start = perf_counter()
+            frame = capture()
+            if frame is None:
+                stop.set()
+                break
+            captured.put((frame, start, perf_counter() - start))
+
+    def process_worker():
+        while not stop.is_set():
+            try:
+                frame, start, capture_time = captured.get(timeout=0.1)
+            except Empty:
+                continue
+            begin = perf_counter()
+            result = process(frame)
+            processed.put((result, start, capture_time, perf_counter() - begin))
+
+    workers = [Thread(target=capture_worker, daemon=True), Thread(target=process_worker, daemon=True)]
+    for worker in workers:
+        worker.start()
+
+    try:
+        while not stop.is_set():
+            try:
+                result, start, capture_time, process_time = processed.get(timeout=0.1)
+            except Empty:
+                continue
+            begin = perf_counter()
+            if display(result) is False:
+                break
+            end = perf_counter()
+            stats.add("capture", capture_time)
+            stats.add("process", process_time)
+            stats.add("display", end - begin)
+            stats.add("latency", end - start)
+            stats.frame_done(captured.dropped + processed.dropped)
+    finally:
+        stop.set()
+        for worker in workers:
+            worker.join(timeout=1.0)
+    return stats
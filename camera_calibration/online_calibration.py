@@ -0,0 +1,292 @@
+######## Online calibration during the capture for the RPI IR-Cut camera #########
+
+# Author: Petros626
+# Description:
+# Before, the images were taken with ir_cut_picamera2_array.py and calibrated offline with
+# calibrate_camera.py, so it was only known afterwards if there were enough good views.
+# This program calibrates while the frames stream in: a background worker detects the board in
+# the latest frame (older frames are dropped, so the capture loop never waits), accepts views which
+# differ enough from the accepted ones (board position, scale and tilt) and re-solves the intrinsics
+# every few views with the previous estimate as start (CALIB_USE_INTRINSIC_GUESS). The capture stops
+# automatically, when the camera matrix and the re-projection error converged. The accepted views
+# are saved, so the offline calibration can be repeated, and the result is saved like the offline one.
+
+# Example usage to calibrate with the camera until the parameters converge:
+# python3 -m camera_calibration online --imgdir=calib_images --board=9x6
+# Example usage to replay the bundled images without camera and window:
+# python3 -m camera_calibration online --source=camera_calibration/opencv_data --board=9x6 --headless
+
+from cv2 import (
+    TERM_CRITERIA_EPS, TERM_CRITERIA_MAX_ITER, CALIB_CB_ADAPTIVE_THRESH, CALIB_CB_FAST_CHECK, CALIB_CB_NORMALIZE_IMAGE,
+    CALIB_USE_INTRINSIC_GUESS, COLOR_BGRA2GRAY, FONT_HERSHEY_SIMPLEX, cvtColor, calibrateCamera, putText, imshow,
+    namedWindow, resizeWindow, waitKey, destroyAllWindows, WINDOW_NORMAL
+)
+from numpy import mgrid, zeros, float32, asarray, sqrt
+from threading import Thread, Event, Lock
+from queue import Empty
+from time import perf_counter
+from os import getcwd, path, makedirs
+from argparse import ArgumentParser
+from json import dump
+from sys import exit
+from .calibrate_camera import find_corners
+from .view_selection import view_features, FEATURE_WEIGHTS
+from .calib_bundle import save_bundle, bundle_filename
+from .live_pipeline import LatestQueue, SnapshotWriter
+from .frame_sources import open_source, KeyboardInput, ScriptedInput
+
+
+# Define OnlineCalibrator class to detect and calibrate on a background thread
+class OnlineCalibrator():
+    # Constructor with instance attributes
+    def __init__(self, board, size, min_views=6, solve_every=3, min_distance=0.1, tolerance=0.005,
+                 max_error_change=0.02, patience=2, pyramid=0, writer=None, crop=None):
+        self.board = board
+        self.size = tuple(size)
+        self.min_views = min_views
+        self.solve_every = solve_every
+        self.min_distance = min_distance
+        self.tolerance = tolerance
+        self.max_error_change = max_error_change
+        self.patience = patience
+        self.pyramid = pyramid
+        self.writer = writer
+        self.crop = crop
+        self.flags = CALIB_CB_ADAPTIVE_THRESH + CALIB_CB_FAST_CHECK + CALIB_CB_NORMALIZE_IMAGE
+        self.criteria = (TERM_CRITERIA_EPS + TERM_CRITERIA_MAX_ITER, 30, 0.001)
+        self.objp = zeros((1, board[0] * board[1], 3), float32)
+        self.objp[0,:,:2] = mgrid[0:board[0], 0:board[1]].T.reshape(-1, 2)
+        self.objpoints = []
+        self.imgpoints = []
+        self.features = []
+        self.views = []
+        self.ret = None
+        self.mtx = None
+        self.dist = None
+        self.rvecs = None
+        self.tvecs = None
+        self.solves = 0
+        self.stable = 0
+        self.frames = 0
+        self.detect_time = 0
+        self.solve_time = 0
+        self.lock = Lock()
+        self.queue = LatestQueue(1)
+        self.stop = Event()
+        self.converged = Event()
+        self.thread = Thread(target=self.worker, daemon=True)
+
+    # Function to start the background worker
+    def start(self):
+        self.thread.start()
+
+    # Function to hand a frame to the worker, never blocks (an older waiting frame is dropped)
+    def submit(self, frame):
+        self.queue.put(frame)
+
+    # Function of the background thread which detects the board and re-solves the calibration
+    def worker(self):
+        while not self.converged.is_set():
+            try:
+                frame = self.queue.get(timeout=0.1)
+            except Empty:
+                # The waiting frame is still processed after the stop
+                if self.stop.is_set():
+                    break
+                continue
+            self.add_frame(frame)
+
+    # Function to detect the board in a frame and to accept it, if the view is new enough
+    def add_frame(self, frame):
+        if (frame.shape[1], frame.shape[0]) != self.size:
+            print("\rFrame with {}x{} skipped (calibration size {}x{}).".format(frame.shape[1], frame.shape[0], *self.size))
+            return False
+        start = perf_counter()
+        gray = cvtColor(frame, COLOR_BGRA2GRAY) if frame.ndim == 3 else frame
+        ret, corners_ = find_corners(gray, self.board, self.flags, self.criteria, self.pyramid)
+        self.detect_time += perf_counter() - start
+        self.frames += 1
+        if ret == False:
+            return False
+
+        features = view_features(corners_, self.board, self.size) * FEATURE_WEIGHTS
+        if self.features:
+            distance = sqrt(((asarray(self.features) - features) ** 2).sum(axis=1)).min()
+            if distance < self.min_distance:
+                return False
+
+        with self.lock:
+            self.objpoints.append(self.objp)
+            self.imgpoints.append(corners_)
+            self.features.append(features)
+            name = self.writer.save(frame[:, :, :3]) if self.writer is not None and frame.ndim == 3 else None
+            self.views.append(name or "view_{}".format(len(self.views) + 1))
+        print("\rView {} accepted ({} frames detected).".format(len(self.objpoints), self.frames))
+
+        views = len(self.objpoints)
+        if views >= self.min_views and (views - self.min_views) % self.solve_every == 0:
+            self.solve()
+        return True
+
+    # Function to re-solve the calibration, warm started with the previous estimate
+    def solve(self):
+        with self.lock:
+            objpoints, imgpoints = list(self.objpoints), list(self.imgpoints)
+        start = perf_counter()
+        if self.mtx is None:
+            ret, mtx, dist, rvecs, tvecs = calibrateCamera(objpoints, imgpoints, self.size, None, None)
+        else:
+            ret, mtx, dist, rvecs, tvecs = calibrateCamera(objpoints, imgpoints, self.size, self.mtx.copy(), self.dist.copy(),
+                                                           flags=CALIB_USE_INTRINSIC_GUESS)
+        elapsed = perf_counter() - start
+        self.solve_time += elapsed
+        self.solves += 1
+
+        if self.mtx is not None:
+            # Largest relative change of fx, fy, cx and cy and change of the RMS in px
+            previous = asarray([self.mtx[0, 0], self.mtx[1, 1], self.mtx[0, 2], self.mtx[1, 2]])
+            current = asarray([mtx[0, 0], mtx[1, 1], mtx[0, 2], mtx[1, 2]])
+            change = (abs(current - previous) / previous).max()
+            error_change = abs(ret - self.ret)
+            self.stable = self.stable + 1 if change <= self.tolerance and error_change <= self.max_error_change else 0
+            print("\rSolve {}: {} views, RMS {:.4f} px, change {:.2%} / {:.4f} px ({:.0f} ms)".format(
+                self.solves, len(objpoints), ret, change, error_change, elapsed * 1000))
+        else:
+            print("\rSolve {}: {} views, RMS {:.4f} px ({:.0f} ms)".format(self.solves, len(objpoints), ret, elapsed * 1000))
+        with self.lock:
+            self.ret, self.mtx, self.dist, self.rvecs, self.tvecs = ret, mtx, dist, rvecs, tvecs
+        if self.stable >= self.patience:
+            print("\rCalibration converged after {} views.".format(len(objpoints)))
+            self.converged.set()
+
+    # Function to get the status text for the preview
+    def status(self):
+        if self.converged.is_set():
+            state = "converged"
+        elif self.ret is None:
+            state = "collecting"
+        else:
+            state = "RMS {:.3f} px, stable {}/{}".format(self.ret, self.stable, self.patience)
+        return "views: {} | {}".format(len(self.objpoints), state)
+
+    # Function to stop the worker and to solve a last time with all accepted views
+    def close(self):
+        self.stop.set()
+        self.thread.join()
+        if len(self.objpoints) >= 3 and (self.mtx is None or len(self.rvecs) != len(self.objpoints)):
+            self.solve()
+
+    # Function to save the calibration like calibrate_camera.py (JSON and binary bundle)
+    def save(self, filename):
+        calibrate_camera = {"ret": float(self.ret), "mtx": asarray(self.mtx).tolist(), "dist": asarray(self.dist).tolist(),
+                            "rvecs": asarray(self.rvecs).tolist(), "tvecs": asarray(self.tvecs).tolist(), "views": self.views,
+                            "size": list(self.size), "crop": None if self.crop is None else list(self.crop)}
+        with open(filename, "w") as f:
+            dump(calibrate_camera, f, indent=4)
+        save_bundle(bundle_filename(filename), self.mtx, self.dist, [(self.size, 0), (self.size, 1)],
+                    {"ret": float(self.ret), "size": list(self.size), "crop": calibrate_camera["crop"]})
+        print("Save the parameters to -> {}.".format(filename))
+
+
+# Function to run the command line interface
+def main(argv=None):
+    parser = ArgumentParser()
+    parser.add_argument("--imgdir", help = "Folder where the accepted views get saved.",
+                        default = "calib_images")
+    parser.add_argument("--board", help = "Dimensions of your checkerboard.",
+                        default = "9x6")
+    parser.add_argument("--res", help = "Resolution of the camera in WxH.",
+                        default = "1920x1080")
+    parser.add_argument("--source", help = "Frame source: 'camera', a directory of images or a video file to replay.",
+                        default = "camera")
+    parser.add_argument("--fps", type=float, help = "Target FPS of a replayed source (0 = as fast as possible).",
+                        default = 0)
+    parser.add_argument("--loop", action="store_true", help = "Repeat a replayed source endlessly.")
+    parser.add_argument("--headless", action="store_true", help = "Run without preview window and keyboard.")
+    parser.add_argument("--min-views", type=int, help = "Number of views before the first solve.",
+                        default = 6)
+    parser.add_argument("--solve-every", type=int, help = "Re-solve after this number of new views.",
+                        default = 3)
+    parser.add_argument("--min-distance", type=float, help = "Minimal distance of a new view to the accepted views (position, scale and tilt).",
+                        default = 0.1)
+    parser.add_argument("--tolerance", type=float, help = "Largest relative change of fx, fy, cx and cy which counts as converged.",
+                        default = 0.005)
+    parser.add_argument("--max-error-change", type=float, help = "Largest change of the RMS in px which counts as converged.",
+                        default = 0.02)
+    parser.add_argument("--patience", type=int, help = "Number of converged solves in a row before the capture stops.",
+                        default = 2)
+    parser.add_argument("--pyramid", type=int, help = "Search the board on a copy downscaled to this size of the longer side (0 = off).",
+                        default = 320)
+    parser.add_argument("--calib", help = "Calibration file for the result.",
+                        default = "calibrate_camera.json")
+    args = parser.parse_args(argv)
+
+    if not "x" in args.board or not "x" in args.res:
+        print("Specify board and resolution with x as WxH. (Example: 9x6, 1920x1080)")
+        exit()
+    board = tuple(map(int, args.board.split("x")))
+    res = tuple(map(int, args.res.split("x")))
+
+    dirpath = path.join(getcwd(), args.imgdir)
+    if not path.exists(dirpath):
+        makedirs(dirpath)
+    writer = SnapshotWriter(dirpath, path.basename(args.imgdir))
+    source = open_source(args.source, res, args.fps, args.loop)
+    keys = ScriptedInput() if args.headless else KeyboardInput()
+    source.start()
+    calibrator = OnlineCalibrator(board, source.size, args.min_views, args.solve_every, args.min_distance, args.tolerance,
+                                  args.max_error_change, args.patience, args.pyramid, writer, source.crop)
+
+    print("\n##########################")
+    print("### Online calibration ###")
+    print("##########################")
+    print("Move the board through the whole image, the capture stops when the calibration converged.")
+    print("To quit the application press 'q'.\n")
+
+    winname = "Online calibration"
+    if not args.headless:
+        namedWindow(winname, WINDOW_NORMAL)
+        resizeWindow(winname, 1000, 900)
+
+    calibrator.start()
+    frames = 0
+    start = perf_counter()
+    try:
+        # The capture loop only hands the frames over, detection and solving run on the worker
+        while not calibrator.converged.is_set():
+            frame = source.capture()
+            if frame is None:
+                print("\rEnd of the frame source.")
+                break
+            frames += 1
+            calibrator.submit(frame)
+            if not args.headless:
+                shown = frame.copy()
+                putText(shown, calibrator.status(), (20, 50), FONT_HERSHEY_SIMPLEX, 1.5, (0, 255, 0, 255), 3)
+                imshow(winname, shown)
+                waitKey(1)
+            if keys.is_pressed("q"):
+                print("\rInterruption: stop the capture...")
+                break
+        elapsed = perf_counter() - start
+        calibrator.close()
+    finally:
+        writer.close()
+        if not args.headless:
+            destroyAllWindows()
+        source.close()
+        keys.close()
+
+    print("\n{} frames in {:.2f} s ({:.1f} FPS), {} frames detected, {} dropped by the worker.".format(
+        frames, elapsed, frames / elapsed, calibrator.frames, calibrator.queue.dropped))
+    print("Detection {:.2f} s, {} solves {:.2f} s.".format(calibrator.detect_time, calibrator.solves, calibrator.solve_time))
+    if calibrator.mtx is None:
+        print("Not enough views for a calibration.")
+        exit(1)
+    print("{} views, RMS {:.4f} px, converged: {}".format(len(calibrator.objpoints), calibrator.ret, calibrator.converged.is_set()))
+    print("Camera matrix: \n\n", calibrator.mtx)
+    calibrator.save(args.calib)
+
+
+if __name__ == "__main__":
+    main()
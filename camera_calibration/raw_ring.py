@@ -0,0 +1,249 @@
+######## Raw capture into a memory mapped ring file for the RPI IR-Cut camera #########
+
+# Author: Petros626
+# Description:
+# The image taker saves every frame as PNG, so the encoding caps the capture rate and costs CPU on the
+# Pi. This program records the raw frames with their timestamps into a preallocated, memory mapped
+# ring file: every frame is one copy into its slot, the oldest frames are overwritten when the ring
+# is full. The sustained FPS and the dropped frames (gaps in the timestamps) are reported. A separate
+# offline step extracts selected frames of the ring file, undistorts and encodes them, also on another
+# machine, because the ring file describes itself.
+
+# Layout of the ring file (little endian):
+# MAGIC (8 bytes) | version (uint32) | header length (uint32) | header (JSON) | padding |
+# written (int64) | capacity x (sequence number int64, timestamp float64) | padding | capacity x frame
+# The frames start at a multiple of 4096 bytes, the header holds shape, capacity and offsets.
+
+# Example usage to record 10 s of the camera into a ring of 300 frames:
+# python3 -m camera_calibration ring --ring=capture.ring --capacity=300 --duration=10
+# Example usage to extract, undistort and encode every 10th frame of the ring:
+# python3 -m camera_calibration ring --extract --ring=capture.ring --outdir=images --every=10 --calib=calibrate_camera.json
+
+from numpy import memmap, ndarray, uint8, int64, float64, dtype, diff, median
+from struct import pack, unpack
+from json import dumps, loads
+from time import perf_counter
+from os import path, makedirs
+from argparse import ArgumentParser
+from sys import exit
+
+MAGIC = b"RAWRING1"
+VERSION = 1
+PAGE = 4096
+ENTRY = dtype([("seq", int64), ("timestamp", float64)])
+
+
+# Define RingFile class to write and read the frames of a ring file
+class RingFile():
+    # Constructor with instance attributes, use create_ring or open_ring
+    def __init__(self, filename, header, data):
+        self.filename = filename
+        self.header = header
+        self.shape = tuple(header["shape"])
+        self.capacity = header["capacity"]
+        self.data = data
+        index = header["index_offset"]
+        self.written = ndarray((1,), dtype=int64, buffer=data, offset=index)
+        self.index = ndarray((self.capacity,), dtype=ENTRY, buffer=data, offset=index + 8)
+        self.frames = ndarray((self.capacity,) + self.shape, dtype=uint8, buffer=data, offset=header["data_offset"])
+
+    # Function to copy a frame into the next slot, the oldest frame is overwritten when the ring is full
+    def write(self, frame, timestamp):
+        seq = int(self.written[0])
+        slot = seq % self.capacity
+        # Mark the slot as invalid while it is written, so a reader never takes a torn frame
+        self.index[slot]["seq"] = -1
+        self.frames[slot] = frame
+        self.index[slot] = (seq, timestamp)
+        self.written[0] = seq + 1
+        return seq
+
+    # Function to get the sequence numbers of the frames which are still in the ring
+    def sequence_numbers(self):
+        written = int(self.written[0])
+        return [seq for seq in range(max(0, written - self.capacity), written) if self.index[seq % self.capacity]["seq"] == seq]
+
+    # Function to read a frame (view into the file) and its timestamp by sequence number
+    def read(self, seq):
+        slot = seq % self.capacity
+        if self.index[slot]["seq"] != seq:
+            raise KeyError("Frame {} isn't in the ring anymore.".format(seq))
+        return self.frames[slot], float(self.index[slot]["timestamp"])
+
+    # Function to write the mapped pages to the file
+    def flush(self):
+        self.data.flush()
+
+
+# Function to create a preallocated ring file for capacity frames of the shape (h, w, channels)
+def create_ring(filename, shape, capacity, meta=None):
+    header = {"shape": list(shape), "capacity": capacity, "meta": meta or {}}
+    # Offsets depend on the header length, so they are written with a fixed width
+    header.update({"index_offset": 0, "data_offset": 0})
+    length = len(dumps(header)) + 64
+    index_offset = (len(MAGIC) + 8 + length + 7) // 8 * 8
+    data_offset = (index_offset + 8 + capacity * ENTRY.itemsize + PAGE - 1) // PAGE * PAGE
+    header.update({"index_offset": index_offset, "data_offset": data_offset})
+    encoded = dumps(header).encode("utf-8").ljust(length)
+    slot_bytes = shape[0] * shape[1] * shape[2]
+
+    with open(filename, "wb") as f:
+        f.write(MAGIC + pack("<II", VERSION, length) + encoded)
+        # Preallocate the whole file, so the capture never waits for the file to grow
+        f.truncate(data_offset + capacity * slot_bytes)
+    data = memmap(filename, dtype=uint8, mode="r+")
+    ring = RingFile(filename, header, data)
+    ring.written[0] = 0
+    ring.index["seq"] = -1
+    return ring
+
+
+# Function to open an existing ring file (read-only by default)
+def open_ring(filename, mode="r"):
+    with open(filename, "rb") as f:
+        magic = f.read(len(MAGIC))
+        version, length = unpack("<II", f.read(8))
+        if magic != MAGIC:
+            raise ValueError("{} is no ring file.".format(filename))
+        if version != VERSION:
+            raise ValueError("Ring file version {} is not supported (expected {}).".format(version, VERSION))
+        header = loads(f.read(length).decode("utf-8"))
+    return RingFile(filename, header, memmap(filename, dtype=uint8, mode=mode))
+
+
+# Function to record the frames of a source into the ring, until the duration or the number of
+# frames is reached or the source ends. The frames are copied straight out of the mapped request.
+# first_timestamp and the start time are given, if the first frame was already written into the ring.
+def record(source, ring, duration=0, frames=0, first_timestamp=None, start=None):
+    timestamps, captured = [], 0
+    if first_timestamp is not None:
+        timestamps, captured = [first_timestamp], 1
+    start = perf_counter() if start is None else start
+    while (not duration or perf_counter() - start < duration) and (not frames or captured < frames):
+        with source.mapped() as raw:
+            if raw is None:
+                break
+            timestamp = source.timestamp if source.timestamp is not None else perf_counter()
+            ring.write(raw, timestamp)
+        timestamps.append(timestamp)
+        captured += 1
+    elapsed = perf_counter() - start
+    ring.flush()
+
+    # Gaps of more than 1.5 frame intervals count as dropped frames. A replay without target FPS has
+    # no frame interval, its gaps are only the decoding jitter.
+    dropped = None
+    if (source.timestamp is not None or getattr(source, "fps", 0)) and len(timestamps) > 2:
+        dropped = 0
+        intervals = diff(timestamps)
+        interval = median(intervals)
+        if interval > 0:
+            dropped = int(sum(round(gap / interval) - 1 for gap in intervals if gap > 1.5 * interval))
+    overwritten = max(0, captured - ring.capacity)
+    print("{} frames in {:.2f} s ({:.1f} FPS), {} dropped, {} overwritten in the ring.".format(
+        captured, elapsed, captured / elapsed if elapsed else 0, "n/a" if dropped is None else dropped, overwritten))
+    return {"frames": captured, "elapsed": elapsed, "dropped": dropped, "overwritten": overwritten}
+
+
+# Function to extract frames of the ring: optionally undistorted with the calibration and cropped to
+# the ROI, encoded in the given format. first/last are positions in the recorded frames.
+def extract(ring, outdir, calib=None, alpha=0, first=0, last=None, every=1, ext="png", crop=False):
+    from cv2 import imwrite, cvtColor, COLOR_BGRA2BGR
+    if not path.exists(outdir):
+        makedirs(outdir)
+    maps = None
+    if calib is not None:
+        from .calib_bundle import load_maps
+        from .undistort_maps import undistort_frame
+        h, w = ring.shape[:2]
+        meta = ring.header["meta"]
+        _, _, map1, map2, _, roi = load_maps(calib, (w, h), alpha, crop=tuple(meta["crop"]) if meta.get("crop") else None)
+        maps = (map1, map2)
+
+    start = perf_counter()
+    saved = 0
+    dst = None
+    for seq in ring.sequence_numbers()[first:last:every]:
+        frame, timestamp = ring.read(seq)
+        if maps is not None:
+            dst = undistort_frame(frame, maps[0], maps[1], dst)
+            frame = dst
+            if crop:
+                x, y, w, h = roi
+                frame = frame[y:y+h, x:x+w]
+        if frame.shape[2] == 4:
+            frame = cvtColor(frame, COLOR_BGRA2BGR)
+        filename = "frame_{:06d}.{}".format(seq, ext)
+        imwrite(path.join(outdir, filename), frame)
+        saved += 1
+    elapsed = perf_counter() - start
+    print("{} frames extracted to {} in {:.2f} s ({:.1f} frames/s).".format(saved, outdir, elapsed, saved / elapsed if elapsed else 0))
+    return saved
+
+
+# Function to run the command line interface
+def main(argv=None):
+    parser = ArgumentParser()
+    parser.add_argument("--ring", help = "Ring file of the raw frames.",
+                        default = "capture.ring")
+    parser.add_argument("--extract", action="store_true", help = "Extract frames of the ring file instead of recording.")
+    parser.add_argument("--source", help = "Frame source: 'camera', a directory of images or a video file to replay.",
+                        default = "camera")
+    parser.add_argument("--res", help = "Resolution of the camera in WxH.",
+                        default = "1920x1080")
+    parser.add_argument("--fps", type=float, help = "Target FPS of a replayed source (0 = as fast as possible).",
+                        default = 0)
+    parser.add_argument("--loop", action="store_true", help = "Repeat a replayed source endlessly.")
+    parser.add_argument("--capacity", type=int, help = "Number of frames in the ring.",
+                        default = 300)
+    parser.add_argument("--duration", type=float, help = "Recording time in s (0 = until the number of frames or the end of the source).",
+                        default = 0)
+    parser.add_argument("--frames", type=int, help = "Number of recorded frames (0 = no limit).",
+                        default = 0)
+    parser.add_argument("--outdir", help = "Folder for the extracted frames.",
+                        default = "images")
+    parser.add_argument("--range", help = "Range FIRST:LAST of the recorded frames to extract (e.g. 10:50).",
+                        default = ":")
+    parser.add_argument("--every", type=int, help = "Extract every N-th frame.",
+                        default = 1)
+    parser.add_argument("--calib", help = "Undistort the extracted frames with this calibration file.",
+                        default = None)
+    parser.add_argument("--alpha", type=float, help = "Free scaling parameter of the optimal camera matrix (0 = only valid pixels, 1 = all pixels).",
+                        default = 0)
+    parser.add_argument("--crop", action="store_true", help = "Crop the undistorted frames to the ROI.")
+    parser.add_argument("--format", help = "File format of the extracted frames (png or jpg).",
+                        default = "png")
+    args = parser.parse_args(argv)
+
+    if args.extract:
+        first, last = (int(v) if v else None for v in args.range.split(":"))
+        extract(open_ring(args.ring), args.outdir, args.calib, args.alpha, first or 0, last, args.every, args.format, args.crop)
+        exit()
+
+    if not "x" in args.res:
+        print("Specify resolution with x as WxH. (Example: 1920x1080).")
+        exit()
+    from .frame_sources import open_source
+    source = open_source(args.source, tuple(map(int, args.res.split("x"))), args.fps, args.loop)
+    source.start()
+    try:
+        # The first frame gives the shape of the ring and is recorded as frame 0
+        start = perf_counter()
+        with source.mapped() as first_frame:
+            if first_frame is None:
+                print("The source has no frames.")
+                exit(1)
+            shape = first_frame.shape
+            first_timestamp = source.timestamp if source.timestamp is not None else perf_counter()
+            meta = {"source": args.source, "crop": None if source.crop is None else list(source.crop)}
+            ring = create_ring(args.ring, shape, args.capacity, meta)
+            ring.write(first_frame, first_timestamp)
+        print("Ring file {} with {} frames of {}x{} ({:.1f} MB).".format(
+            args.ring, args.capacity, shape[1], shape[0], path.getsize(args.ring) / 1e6))
+        record(source, ring, args.duration, args.frames, first_timestamp, start)
+    finally:
+        source.close()
+
+
+if __name__ == "__main__":
+    main()
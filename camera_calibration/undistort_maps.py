@@ -0,0 +1,164 @@
+######## Precomputed undistortion maps for the RPI IR-Cut camera #########
+
+# Author: Petros626
+# Description:
+# cv2.undistort builds the complete distortion map on every call, although the camera matrix,
+# the distortion coefficients and the resolution never change during a capture session.
+# This module builds the undistort/rectify maps once in the compact fixed-point format (CV_16SC2),
+# so every frame only needs a plain remap. The maps are saved in the calibration bundle
+# (see calib_bundle.py), keyed by resolution and alpha, so a restart skips building them.
+# OpenCV is only imported when maps are built or applied, so loading a calibration stays fast.
+
+# Example usage to compare undistort and remap for a 1920x1080 frame:
+# python3 -m camera_calibration maps --res=1920x1080 --alpha=0
+
+from numpy import array, float64, uint8
+from json import load
+from time import perf_counter
+from argparse import ArgumentParser
+
+
+# Function to load the camera matrix and the distortion coefficients of the calibration file
+def load_calibration(filename="calibrate_camera.json"):
+    with open(filename, "r") as f:
+        calibration_file = load(f)
+    mtx = array(calibration_file["mtx"], dtype=float64)
+    dist = array(calibration_file["dist"], dtype=float64)
+    return mtx, dist
+
+
+# Function to build the fixed-point maps for the given resolution (w, h) and alpha. With out_size
+# the maps undistort and scale in one pass, e.g. straight to the size of the preview window.
+def build_undistort_maps(mtx, dist, size, alpha=0, out_size=None):
+    from cv2 import CV_16SC2, getOptimalNewCameraMatrix, initUndistortRectifyMap
+    optimal_camera_matrix, roi = getOptimalNewCameraMatrix(mtx, dist, size, alpha, size)
+    if out_size is not None and tuple(out_size) != tuple(size):
+        optimal_camera_matrix, roi = scale_camera_matrix(optimal_camera_matrix, roi, size, out_size)
+    else:
+        out_size = size
+    map1, map2 = initUndistortRectifyMap(mtx, dist, None, optimal_camera_matrix, tuple(out_size), CV_16SC2)
+    return map1, map2, optimal_camera_matrix, roi
+
+
+# Function to scale a camera matrix and its ROI from size to out_size (pixel centers stay aligned)
+def scale_camera_matrix(camera_matrix, roi, size, out_size):
+    sx, sy = out_size[0] / size[0], out_size[1] / size[1]
+    scaled = array(camera_matrix, dtype=float64)
+    scaled[0, 0] *= sx
+    scaled[0, 1] *= sx
+    scaled[0, 2] = (scaled[0, 2] + 0.5) * sx - 0.5
+    scaled[1, 1] *= sy
+    scaled[1, 2] = (scaled[1, 2] + 0.5) * sy - 0.5
+    x, y, w, h = roi
+    return scaled, (int(round(x * sx)), int(round(y * sy)), int(round(w * sx)), int(round(h * sy)))
+
+
+# Function to convert the camera matrix of images of size, which show the sensor crop (x, y, w, h), to
+# images of out_size showing out_crop (both crops in sensor pixels). Without crops both images show
+# the same field of view, so only the scale changes. The distortion coefficients stay the same,
+# because they work on normalised coordinates.
+def convert_camera_matrix(mtx, size, out_size, crop=None, out_crop=None):
+    if crop is None or out_crop is None:
+        if abs(out_size[0] * size[1] - out_size[1] * size[0]) > 0.01 * size[0] * size[1]:
+            raise ValueError("{}x{} has another aspect ratio than the calibration ({}x{}), the sensor crops of both are needed.".format(
+                out_size[0], out_size[1], size[0], size[1]))
+        crop = out_crop = (0, 0, size[0], size[1])
+    x, y, w, h = crop
+    out_x, out_y, out_w, out_h = out_crop
+    if out_x < x or out_y < y or out_x + out_w > x + w or out_y + out_h > y + h:
+        print("Warning: the crop {} exceeds the calibrated field of view {}, the distortion is extrapolated.".format(tuple(out_crop), tuple(crop)))
+    sx, sy = size[0] / w, size[1] / h
+    out_sx, out_sy = out_size[0] / out_w, out_size[1] / out_h
+    converted = array(mtx, dtype=float64)
+    # Pixel edges: p_image = (p_sensor - crop offset) * scale, pixel centers are at p - 0.5
+    converted[0, 0] *= out_sx / sx
+    converted[0, 1] *= out_sx / sx
+    converted[1, 1] *= out_sy / sy
+    converted[0, 2] = ((converted[0, 2] + 0.5) / sx + x - out_x) * out_sx - 0.5
+    converted[1, 2] = ((converted[1, 2] + 0.5) / sy + y - out_y) * out_sy - 0.5
+    return converted
+
+
+# Function to undistort a frame with the precomputed maps
+def undistort_frame(frame, map1, map2, dst=None):
+    from cv2 import INTER_LINEAR, remap
+    return remap(frame, map1, map2, INTER_LINEAR, dst=dst)
+
+
+# Function to compare the per-frame undistort (as used before) with the precomputed remap
+def benchmark_undistort(mtx, dist, size, alpha=0, frames=50, out_size=None):
+    from cv2 import INTER_AREA, getOptimalNewCameraMatrix, undistort, resize
+    from numpy import random
+    frame = random.randint(0, 256, (size[1], size[0], 3), dtype=uint8)
+
+    start = perf_counter()
+    for _ in range(frames):
+        optimal_camera_matrix, roi = getOptimalNewCameraMatrix(mtx, dist, size, alpha, size)
+        undistort(frame, mtx, dist, None, optimal_camera_matrix)
+    time_undistort = (perf_counter() - start) / frames
+
+    start = perf_counter()
+    map1, map2, optimal_camera_matrix, roi = build_undistort_maps(mtx, dist, size, alpha)
+    time_build = perf_counter() - start
+
+    dst = None
+    start = perf_counter()
+    for _ in range(frames):
+        dst = undistort_frame(frame, map1, map2, dst)
+    time_remap = (perf_counter() - start) / frames
+
+    print("Resolution: {}x{}, alpha: {:g}".format(size[0], size[1], alpha))
+    print("undistort per frame:   {:.2f} ms".format(time_undistort * 1000))
+    print("map building (once):   {:.2f} ms".format(time_build * 1000))
+    print("remap per frame:       {:.2f} ms".format(time_remap * 1000))
+    print("Speedup:               {:.2f}x".format(time_undistort / time_remap))
+    timings = {"undistort": time_undistort, "build": time_build, "remap": time_remap}
+    if out_size is None:
+        return timings
+
+    # Full resolution remap and downscale vs. one fused remap to the output size
+    map1_out, map2_out, _, _ = build_undistort_maps(mtx, dist, size, alpha, out_size)
+    start = perf_counter()
+    for _ in range(frames):
+        resize(undistort_frame(frame, map1, map2, dst), tuple(out_size), interpolation=INTER_AREA)
+    time_resize = (perf_counter() - start) / frames
+
+    out = None
+    start = perf_counter()
+    for _ in range(frames):
+        out = undistort_frame(frame, map1_out, map2_out, out)
+    time_fused = (perf_counter() - start) / frames
+
+    print("remap + resize to {}x{}: {:.2f} ms".format(out_size[0], out_size[1], time_resize * 1000))
+    print("fused remap to {}x{}:    {:.2f} ms".format(out_size[0], out_size[1], time_fused * 1000))
+    timings.update({"remap_resize": time_resize, "fused": time_fused})
+    return timings
+
+
+# Function to run the command line interface
+def main(argv=None):
+    parser = ArgumentParser()
+    parser.add_argument("--calib", help = "Calibration file with the camera parameters.",
+                        default = "calibrate_camera.json")
+    parser.add_argument("--res", help = "Resolution in WxH for which undistort and remap are compared.",
+                        default = "1920x1080")
+    parser.add_argument("--alpha", type=float, help = "Free scaling parameter of the optimal camera matrix (0 = only valid pixels, 1 = all pixels).",
+                        default = 0)
+    parser.add_argument("--out", help = "Optional output size in WxH to compare remap + resize with one fused remap (e.g. 1000x900).",
+                        default = None)
+    parser.add_argument("--frames", type=int, help = "Number of frames to average.",
+                        default = 50)
+    args = parser.parse_args(argv)
+
+    if not "x" in args.res:
+        print("Specify resolution with x as WxH. (Example: 1920x1080).")
+        exit()
+    imgW, imgH = map(int, args.res.split("x"))
+
+    mtx, dist = load_calibration(args.calib)
+    out_size = tuple(map(int, args.out.split("x"))) if args.out else None
+    benchmark_undistort(mtx, dist, (imgW, imgH), args.alpha, args.frames, out_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+######## Sparse point undistortion for the RPI IR-Cut camera #########
+
+# Author: Petros626
+# Description:
+# Many consumers only need the undistorted coordinates of a few keypoints or bounding boxes,
+# but the live loop undistorts every full frame. This module undistorts batches of 2D points
+# (vectorized, with the camera matrix, the distortion coefficients and the optimal camera matrix of
+# the calibration) and maps points of the undistorted image back into the distorted image.
+# For many queries a lookup grid is precomputed once, so every point costs a constant bilinear
+# interpolation instead of the iterative undistortion, points outside of the grid take the exact
+# path. Both directions work in pixels of the
+# same images as the remap tables of undistort_maps.py. OpenCV is only imported with the first
+# undistorter, so importing this module and loading a calibration stay fast.
+
+# Example usage to compare the point undistortion with the full frame remap:
+# python3 -m camera_calibration points --calib=calibrate_camera.json --res=1920x1080 --points=1000
+
+from numpy import (
+    asarray, ascontiguousarray, float64, zeros, ones, empty, linspace, meshgrid, stack, concatenate,
+    floor, ceil, arange, uint8, column_stack
+)
+from numpy.linalg import inv
+from time import perf_counter
+from argparse import ArgumentParser
+from sys import exit
+from .undistort_maps import load_calibration, build_undistort_maps, undistort_frame
+
+
+# Iterations of the iterative undistortion, the default 5 iterations leave errors above 1 px in the
+# corners of strongly distorted lenses
+ITERATIONS = 30
+
+
+# Define LookupGrid class, the precomputed mapping of a regular grid of points with bilinear interpolation
+class LookupGrid():
+    # Constructor with instance attributes, values holds the mapped (x, y) of every grid point (rows, cols, 2),
+    # origin is the position of the first grid point
+    def __init__(self, values, step, origin=(0, 0)):
+        self.values = ascontiguousarray(values, dtype=float64)
+        self.step = step
+        self.origin = origin
+        self.rows, self.cols = self.values.shape[:2]
+
+    # Function to check which points (N, 2) lie inside of the grid
+    def contains(self, points):
+        points = asarray(points, dtype=float64).reshape(-1, 2)
+        gx = (points[:, 0] - self.origin[0]) / self.step
+        gy = (points[:, 1] - self.origin[1]) / self.step
+        return (gx >= 0) & (gx <= self.cols - 1) & (gy >= 0) & (gy <= self.rows - 1)
+
+    # Function to map the points (N, 2), points outside of the grid are clamped to its border.
+    # (remap would interpolate in C, but its fixed-point weights cost up to 0.1 px of accuracy)
+    def query(self, points):
+        points = asarray(points, dtype=float64).reshape(-1, 2)
+        gx = ((points[:, 0] - self.origin[0]) / self.step).clip(0, self.cols - 1)
+        gy = ((points[:, 1] - self.origin[1]) / self.step).clip(0, self.rows - 1)
+        x0 = floor(gx).astype(int).clip(0, self.cols - 2)
+        y0 = floor(gy).astype(int).clip(0, self.rows - 2)
+        fx = (gx - x0)[:, None]
+        fy = (gy - y0)[:, None]
+        v = self.values
+        top = v[y0, x0] * (1 - fx) + v[y0, x0 + 1] * fx
+        bottom = v[y0 + 1, x0] * (1 - fx) + v[y0 + 1, x0 + 1] * fx
+        return top * (1 - fy) + bottom * fy
+
+
+# Define PointUndistorter class to undistort and distort batches of points
+class PointUndistorter():
+    # Constructor with instance attributes. Without new_camera_matrix the optimal camera matrix for
+    # size and alpha is used, like for the remap tables.
+    def __init__(self, mtx, dist, size, alpha=0, new_camera_matrix=None):
+        from cv2 import getOptimalNewCameraMatrix
+        self.mtx = asarray(mtx, dtype=float64)
+        self.dist = asarray(dist, dtype=float64)
+        self.size = tuple(size)
+        if new_camera_matrix is None:
+            new_camera_matrix, _ = getOptimalNewCameraMatrix(self.mtx, self.dist, self.size, alpha, self.size)
+        self.new_camera_matrix = asarray(new_camera_matrix, dtype=float64)
+        self.new_camera_matrix_inv = inv(self.new_camera_matrix)
+        self.undistort_grid = None
+        self.distort_grid = None
+
+    # Function to map points (N, 2) of the distorted image into the undistorted image
+    def undistort(self, points):
+        points = asarray(points, dtype=float64).reshape(-1, 1, 2)
+        if len(points) == 0:
+            return empty((0, 2), dtype=float64)
+        from cv2 import undistortPointsIter, TERM_CRITERIA_COUNT, TERM_CRITERIA_EPS
+        criteria = (TERM_CRITERIA_COUNT + TERM_CRITERIA_EPS, ITERATIONS, 1e-9)
+        return undistortPointsIter(points, self.mtx, self.dist, None, self.new_camera_matrix, criteria).reshape(-1, 2)
+
+    # Function to map points (N, 2) of the undistorted image back into the distorted image
+    def distort(self, points):
+        points = asarray(points, dtype=float64).reshape(-1, 2)
+        if len(points) == 0:
+            return empty((0, 2), dtype=float64)
+        from cv2 import projectPoints
+        # Back to normalised camera coordinates (z = 1) and projected with the lens distortion
+        rays = column_stack([points, ones(len(points))]) @ self.new_camera_matrix_inv.T
+        projected, _ = projectPoints(rays.reshape(-1, 1, 3), zeros(3), zeros(3), self.mtx, self.dist)
+        return projected.reshape(-1, 2)
+
+    # Function to undistort bounding boxes (N, 4) as x1, y1, x2, y2. The edges are sampled, because
+    # straight edges of the distorted image are curved in the undistorted image.
+    def undistort_boxes(self, boxes, samples=5):
+        boxes = asarray(boxes, dtype=float64).reshape(-1, 4)
+        t = linspace(0, 1, samples)
+        x1, y1, x2, y2 = (boxes[:, i:i + 1] for i in range(4))
+        xs = concatenate([x1 + (x2 - x1) * t, x1 + (x2 - x1) * t, x1 + 0 * t, x2 + 0 * t], axis=1)
+        ys = concatenate([y1 + 0 * t, y2 + 0 * t, y1 + (y2 - y1) * t, y1 + (y2 - y1) * t], axis=1)
+        mapped = self.undistort(stack([xs, ys], axis=2)).reshape(len(boxes), -1, 2)
+        return concatenate([mapped.min(axis=1), mapped.max(axis=1)], axis=1)
+
+    # Function to precompute the lookup grids of both directions with a point every step pixels. The
+    # undistort grid spans the distorted image. The distort grid spans the bounding box of the
+    # undistorted image, which reaches beyond the image (e.g. in the corners with alpha 0), but at
+    # most one image size on every side.
+    def build_grids(self, step=4):
+        w, h = self.size
+        self.undistort_grid = build_lookup_grid(self.undistort, (0, 0, w, h), step)
+        t = arange(0, 1, step / max(w, h))
+        border = concatenate([column_stack([t * w, 0 * t]), column_stack([t * 0 + w, t * h]),
+                              column_stack([w - t * w, 0 * t + h]), column_stack([0 * t, h - t * h])])
+        mapped = self.undistort(border)
+        box = (max(min(0, floor(mapped[:, 0].min())), -w), max(min(0, floor(mapped[:, 1].min())), -h),
+               min(max(w, ceil(mapped[:, 0].max())), 2 * w), min(max(h, ceil(mapped[:, 1].max())), 2 * h))
+        self.distort_grid = build_lookup_grid(self.distort, box, step)
+
+    # Function to map points with a lookup grid, points outside of the grid are mapped exactly
+    def query_grid(self, grid, exact, points):
+        points = asarray(points, dtype=float64).reshape(-1, 2)
+        inside = grid.contains(points)
+        if inside.all():
+            return grid.query(points)
+        result = empty(points.shape, dtype=float64)
+        result[inside] = grid.query(points[inside])
+        result[~inside] = exact(points[~inside])
+        return result
+
+    # Function to undistort points with the lookup grid (constant time per point)
+    def undistort_fast(self, points):
+        if self.undistort_grid is None:
+            self.build_grids()
+        return self.query_grid(self.undistort_grid, self.undistort, points)
+
+    # Function to distort points with the lookup grid (constant time per point)
+    def distort_fast(self, points):
+        if self.distort_grid is None:
+            self.build_grids()
+        return self.query_grid(self.distort_grid, self.distort, points)
+
+
+# Function to build the lookup grid of a mapping func over the box (x_min, y_min, x_max, y_max)
+def build_lookup_grid(func, box, step):
+    x_min, y_min, x_max, y_max = box
+    xs = x_min + step * arange(int(ceil((x_max - x_min) / step)) + 1)
+    ys = y_min + step * arange(int(ceil((y_max - y_min) / step)) + 1)
+    gx, gy = meshgrid(xs, ys)
+    values = func(stack([gx, gy], axis=2).reshape(-1, 2))
+    return LookupGrid(values.reshape(len(ys), len(xs), 2), step, (x_min, y_min))
+
+
+# Function to compare the point undistortion (exact and lookup grid) with the full frame remap
+def benchmark_points(mtx, dist, size, alpha=0, points=1000, step=4, repeat=50):
+    from numpy import random
+    undistorter = PointUndistorter(mtx, dist, size, alpha)
+    w, h = size
+    pts = random.uniform((0, 0), (w - 1, h - 1), (points, 2))
+
+    def timed(func, *args):
+        start = perf_counter()
+        for _ in range(repeat):
+            result = func(*args)
+        return (perf_counter() - start) / repeat, result
+
+    time_exact, exact = timed(undistorter.undistort, pts)
+    start = perf_counter()
+    undistorter.build_grids(step)
+    time_build = perf_counter() - start
+    time_grid, fast = timed(undistorter.undistort_fast, pts)
+    time_distort, _ = timed(undistorter.distort, exact)
+    roundtrip = undistorter.distort(exact) - pts
+
+    map1, map2, _, _ = build_undistort_maps(mtx, dist, size, alpha)
+    frame = random.randint(0, 256, (h, w, 3), dtype=uint8)
+    time_frame, _ = timed(undistort_frame, frame, map1, map2)
+
+    deviation = ((fast - exact) ** 2).sum(axis=1) ** 0.5
+    print("Resolution: {}x{}, alpha: {:g}, {} points".format(w, h, alpha, points))
+    print("undistortPointsIter:     {:.3f} ms ({:.2f} M points/s)".format(time_exact * 1000, points / time_exact / 1e6))
+    print("lookup grid (step {}):    {:.3f} ms ({:.2f} M points/s), built once in {:.1f} ms".format(
+        step, time_grid * 1000, points / time_grid / 1e6, time_build * 1000))
+    print("distort (inverse):       {:.3f} ms".format(time_distort * 1000))
+    print("full frame remap:        {:.3f} ms".format(time_frame * 1000))
+    print("grid deviation: mean {:.4f} px, max {:.4f} px, round trip max {:.2e} px".format(
+        deviation.mean(), deviation.max(), abs(roundtrip).max()))
+    return {"exact": time_exact, "grid": time_grid, "build": time_build, "distort": time_distort, "frame": time_frame}
+
+
+# Function to run the command line interface
+def main(argv=None):
+    parser = ArgumentParser()
+    parser.add_argument("--calib", help = "Calibration file with the camera parameters.",
+                        default = "calibrate_camera.json")
+    parser.add_argument("--res", help = "Resolution in WxH of the images.",
+                        default = "1920x1080")
+    parser.add_argument("--alpha", type=float, help = "Free scaling parameter of the optimal camera matrix (0 = only valid pixels, 1 = all pixels).",
+                        default = 0)
+    parser.add_argument("--points", type=int, help = "Number of points per batch.",
+                        default = 1000)
+    parser.add_argument("--step", type=int, help = "Distance of the lookup grid points in px.",
+                        default = 4)
+    args = parser.parse_args(argv)
+
+    if not "x" in args.res:
+        print("Specify resolution with x as WxH. (Example: 1920x1080).")
+        exit()
+    imgW, imgH = map(int, args.res.split("x"))
+
+    mtx, dist = load_calibration(args.calib)
+    benchmark_points(mtx, dist, (imgW, imgH), args.alpha, args.points, args.step)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,381 @@
+######## Resident undistortion service for the RPI IR-Cut camera #########
+
+# Author: Petros626
+# Description:
+# Every tool starts from scratch: it imports cv2, parses calibrate_camera.json and builds the optimal
+# camera matrix and the maps again. This program runs as long-running local daemon, which keeps the
+# calibrations, remap tables and point undistorters resident for all requested resolutions. Clients
+# talk to it over a Unix socket with length prefixed JSON messages: frames are passed in shared
+# memory (the client writes the frame, the daemon remaps it into the output segment of the client),
+# point batches are passed in the message. The daemon measures the latency of every request and the
+# queue depth (requests waiting for a free worker slot). The p95 latency is taken over the last
+# requests of an op, so the memory of the statistics stays bounded.
+
+# Example usage to start the daemon:
+# python3 -m camera_calibration service --socket=/tmp/undistort.sock
+# Example usage to replay the bundled images through a running daemon (or --spawn one in-process):
+# python3 -m camera_calibration service --socket=/tmp/undistort.sock --source=camera_calibration/opencv_data --spawn
+
+from socketserver import ThreadingUnixStreamServer, BaseRequestHandler
+from socket import socket, AF_UNIX, SOCK_STREAM
+from multiprocessing.shared_memory import SharedMemory
+from multiprocessing import resource_tracker
+from threading import Thread, Lock, BoundedSemaphore
+from collections import defaultdict, deque
+from struct import pack, unpack
+from json import dumps, loads
+from time import perf_counter, sleep
+from os import path, remove
+from argparse import ArgumentParser
+from sys import exit
+from numpy import ndarray, uint8, asarray
+from .calib_bundle import load_maps
+from .undistort_maps import undistort_frame
+from .undistort_points import PointUndistorter
+
+# Number of the last latencies per op for the p95 latency
+LATENCY_WINDOW = 1000
+
+
+# Function to send a message (4 byte length + JSON)
+def send_message(sock, message):
+    data = dumps(message).encode("utf-8")
+    sock.sendall(pack("<I", len(data)) + data)
+
+
+# Function to receive exactly size bytes, None if the connection was closed
+def recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+
+# Function to receive a message, None if the connection was closed
+def recv_message(sock):
+    header = recv_exactly(sock, 4)
+    if header is None:
+        return None
+    data = recv_exactly(sock, unpack("<I", header)[0])
+    return None if data is None else loads(data.decode("utf-8"))
+
+
+# Function to attach to a shared memory segment of a client. The client owns the segment, so the
+# resource tracker of the daemon must not unlink it at exit (unless the client runs in the same process).
+def attach_segment(name, untrack=True):
+    segment = SharedMemory(name=name)
+    if untrack:
+        resource_tracker.unregister(segment._name, "shared_memory")
+    return segment
+
+
+# Define UndistortService class, the resident state and the request handling of the daemon
+class UndistortService():
+    # Constructor with instance attributes
+    def __init__(self, workers=2, untrack=True, latency_window=LATENCY_WINDOW):
+        self.untrack = untrack
+        self.maps = {}
+        self.loading = {}
+        self.undistorters = {}
+        self.segments = {}
+        self.slots = BoundedSemaphore(workers)
+        self.lock = Lock()
+        self.waiting = 0
+        self.max_waiting = 0
+        self.requests = 0
+        self.latencies = defaultdict(lambda: deque(maxlen=latency_window))
+        self.counts = defaultdict(int)
+        self.total_latency = defaultdict(float)
+
+    # Function to get the resident maps of a calibration and mode, they are loaded once from the bundle.
+    # Building the maps only holds the lock of the mode, requests of other modes aren't blocked.
+    def get_maps(self, calib, size, alpha):
+        key = (path.abspath(calib), tuple(size), alpha)
+        with self.lock:
+            if key in self.maps:
+                return self.maps[key]
+            mode_lock = self.loading.setdefault(key, Lock())
+        with mode_lock:
+            with self.lock:
+                if key in self.maps:
+                    return self.maps[key]
+            mtx, dist, map1, map2, optimal_camera_matrix, roi = load_maps(calib, tuple(size), alpha)
+            maps = (map1, map2, mtx, dist, optimal_camera_matrix)
+            with self.lock:
+                self.maps[key] = maps
+                self.loading.pop(key, None)
+        print("Loaded maps for {} at {}x{}, alpha {:g}.".format(path.basename(calib), size[0], size[1], alpha))
+        return maps
+
+    # Function to get the resident point undistorter of a calibration and mode
+    def get_undistorter(self, calib, size, alpha):
+        key = (path.abspath(calib), tuple(size), alpha)
+        map1, map2, mtx, dist, optimal_camera_matrix = self.get_maps(calib, size, alpha)
+        with self.lock:
+            if key not in self.undistorters:
+                self.undistorters[key] = PointUndistorter(mtx, dist, size, new_camera_matrix=optimal_camera_matrix)
+            return self.undistorters[key]
+
+    # Function to get a frame array in the shared memory segment of a client
+    def get_array(self, name, shape):
+        with self.lock:
+            if name not in self.segments:
+                self.segments[name] = attach_segment(name, self.untrack)
+            segment = self.segments[name]
+        return ndarray(tuple(shape), dtype=uint8, buffer=segment.buf)
+
+    # Function to handle a request, the number of requests which are processed at once is bounded
+    def handle(self, request):
+        received = perf_counter()
+        op = request.get("op")
+        if op == "stats":
+            return self.stats()
+        if op == "release":
+            self.release(request["segments"])
+            return {"ok": True}
+
+        # Only requests which have to wait for a free slot count for the queue depth
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.waiting += 1
+                self.max_waiting = max(self.max_waiting, self.waiting)
+            self.slots.acquire()
+            with self.lock:
+                self.waiting -= 1
+        try:
+            reply = self.process(op, request)
+        except Exception as e:
+            reply = {"ok": False, "error": "{}: {}".format(type(e).__name__, e)}
+        finally:
+            self.slots.release()
+        latency = perf_counter() - received
+        with self.lock:
+            self.requests += 1
+            self.latencies[op].append(latency)
+            self.counts[op] += 1
+            self.total_latency[op] += latency
+        reply["latency_ms"] = latency * 1000
+        return reply
+
+    # Function to process a frame or point request
+    def process(self, op, request):
+        calib, alpha = request.get("calib", "calibrate_camera.json"), request.get("alpha", 0)
+        if op == "frame":
+            shape = request["shape"]
+            size = (shape[1], shape[0])
+            map1, map2 = self.get_maps(calib, size, alpha)[:2]
+            frame = self.get_array(request["input"], shape)
+            out = self.get_array(request["output"], shape)
+            undistort_frame(frame, map1, map2, out)
+            return {"ok": True}
+        if op == "points":
+            undistorter = self.get_undistorter(calib, request["size"], alpha)
+            points = undistorter.distort(request["points"]) if request.get("inverse") else undistorter.undistort(request["points"])
+            return {"ok": True, "points": points.tolist()}
+        if op == "load":
+            self.get_maps(calib, request["size"], alpha)
+            return {"ok": True}
+        return {"ok": False, "error": "unknown op '{}'".format(op)}
+
+    # Function to detach the shared memory segments of a client
+    def release(self, names):
+        with self.lock:
+            for name in names:
+                segment = self.segments.pop(name, None)
+                if segment is not None:
+                    segment.close()
+
+    # Function to get the latency statistics per op and the queue depth
+    def stats(self):
+        with self.lock:
+            ops = {}
+            for op, values in self.latencies.items():
+                ordered = sorted(values)
+                ops[op] = {"n": self.counts[op], "mean_ms": 1000 * self.total_latency[op] / self.counts[op],
+                           "p95_ms": 1000 * ordered[int(0.95 * (len(ordered) - 1))]}
+            return {"ok": True, "requests": self.requests, "queue_depth": self.waiting, "max_queue_depth": self.max_waiting,
+                    "modes": ["{}x{}_alpha{:g}".format(key[1][0], key[1][1], key[2]) for key in self.maps], "ops": ops}
+
+
+# Function to create the socket server of the service, every client connection gets its own thread
+def create_server(service, socket_path):
+    class Handler(BaseRequestHandler):
+        def handle(self):
+            while 1:
+                request = recv_message(self.request)
+                if request is None:
+                    break
+                send_message(self.request, service.handle(request))
+
+    if path.exists(socket_path):
+        remove(socket_path)
+    server = ThreadingUnixStreamServer(socket_path, Handler)
+    server.daemon_threads = True
+    return server
+
+
+# Define UndistortClient class to use the service
+class UndistortClient():
+    # Constructor with instance attributes
+    def __init__(self, socket_path, calib="calibrate_camera.json", alpha=0):
+        self.sock = socket(AF_UNIX, SOCK_STREAM)
+        self.sock.connect(socket_path)
+        self.calib = path.abspath(calib)
+        self.alpha = alpha
+        self.input = None
+        self.output = None
+        self.shape = None
+
+    # Function to send a request and to wait for the reply
+    def request(self, message):
+        send_message(self.sock, message)
+        reply = recv_message(self.sock)
+        if reply is None:
+            raise ConnectionError("The undistortion service closed the connection.")
+        if not reply.get("ok"):
+            raise RuntimeError(reply.get("error"))
+        return reply
+
+    # Function to undistort a frame in the service. The result is a view of the output segment,
+    # it is only valid until the next call.
+    def undistort(self, frame):
+        if frame.shape != self.shape:
+            self.release()
+            self.input = SharedMemory(create=True, size=frame.nbytes)
+            self.output = SharedMemory(create=True, size=frame.nbytes)
+            self.shape = frame.shape
+        ndarray(frame.shape, dtype=uint8, buffer=self.input.buf)[:] = frame
+        self.request({"op": "frame", "calib": self.calib, "alpha": self.alpha, "shape": list(frame.shape),
+                      "input": self.input.name, "output": self.output.name})
+        return ndarray(frame.shape, dtype=uint8, buffer=self.output.buf)
+
+    # Function to undistort (or with inverse distort) a batch of points (N, 2) of a frame of size (w, h)
+    def points(self, points, size, inverse=False):
+        reply = self.request({"op": "points", "calib": self.calib, "alpha": self.alpha, "size": list(size),
+                              "points": asarray(points, dtype=float).reshape(-1, 2).tolist(), "inverse": inverse})
+        return asarray(reply["points"])
+
+    # Function to get the statistics of the service
+    def stats(self):
+        return self.request({"op": "stats"})
+
+    # Function to free the shared memory segments
+    def release(self):
+        segments = [segment for segment in (self.input, self.output) if segment is not None]
+        if segments:
+            self.request({"op": "release", "segments": [segment.name for segment in segments]})
+        for segment in segments:
+            segment.close()
+            segment.unlink()
+        self.input = self.output = self.shape = None
+
+    def close(self):
+        self.release()
+        self.sock.close()
+
+
+# Function to replay a frame source through the service and to report the round trip latency
+def replay(socket_path, source, calib, alpha=0, frames=0, points=100):
+    client = UndistortClient(socket_path, calib, alpha)
+    round_trips, count = [], 0
+    source.start()
+    try:
+        while not frames or count < frames:
+            frame = source.capture()
+            if frame is None:
+                break
+            start = perf_counter()
+            client.undistort(frame)
+            if points:
+                h, w = frame.shape[:2]
+                client.points([[w * i / points, h * i / points] for i in range(points)], (w, h))
+            round_trips.append(perf_counter() - start)
+            count += 1
+        stats = client.stats()
+    finally:
+        client.close()
+        source.close()
+    ordered = sorted(round_trips)
+    print("{} frames, round trip (frame + {} points): mean {:.2f} ms, p95 {:.2f} ms".format(
+        count, points, 1000 * sum(round_trips) / max(count, 1), 1000 * ordered[int(0.95 * (count - 1))] if count else 0))
+    print_stats(stats)
+    return stats
+
+
+# Function to print the statistics of the service
+def print_stats(stats):
+    print("Service: {} requests, queue depth {} (max {}), modes: {}".format(
+        stats["requests"], stats["queue_depth"], stats["max_queue_depth"], ", ".join(stats["modes"])))
+    for op, values in stats["ops"].items():
+        print("  {:<7} n={:<6} mean {:.2f} ms, p95 {:.2f} ms".format(op, values["n"], values["mean_ms"], values["p95_ms"]))
+
+
+# Function to run the command line interface
+def main(argv=None):
+    parser = ArgumentParser()
+    parser.add_argument("--socket", help = "Path of the Unix socket.",
+                        default = "/tmp/undistort.sock")
+    parser.add_argument("--workers", type=int, help = "Number of requests which are processed at once.",
+                        default = 2)
+    parser.add_argument("--report", type=float, help = "Print the statistics every N seconds (0 = off).",
+                        default = 10)
+    parser.add_argument("--source", help = "Replay this frame source (directory of images or video) through the service instead of serving.",
+                        default = None)
+    parser.add_argument("--fps", type=float, help = "Target FPS of the replayed source (0 = as fast as possible).",
+                        default = 0)
+    parser.add_argument("--frames", type=int, help = "Number of replayed frames (0 = until the source ends).",
+                        default = 0)
+    parser.add_argument("--points", type=int, help = "Number of points undistorted with every replayed frame.",
+                        default = 100)
+    parser.add_argument("--spawn", action="store_true", help = "Start the service in this process for the replay.")
+    parser.add_argument("--calib", help = "Calibration file of the replayed frames.",
+                        default = "calibrate_camera.json")
+    parser.add_argument("--alpha", type=float, help = "Free scaling parameter of the optimal camera matrix (0 = only valid pixels, 1 = all pixels).",
+                        default = 0)
+    args = parser.parse_args(argv)
+
+    if args.source is not None:
+        from .frame_sources import open_source
+        server = None
+        if args.spawn:
+            # The client segments belong to the resource tracker of this process
+            server = create_server(UndistortService(args.workers, untrack=False), args.socket)
+            Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            replay(args.socket, open_source(args.source, fps=args.fps), args.calib, args.alpha, args.frames, args.points)
+        finally:
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+                remove(args.socket)
+        exit()
+
+    service = UndistortService(args.workers)
+    server = create_server(service, args.socket)
+    print("Undistortion service listens on {}.".format(args.socket))
+
+    def report():
+        last = 0
+        while 1:
+            sleep(args.report)
+            stats = service.stats()
+            if stats["requests"] != last:
+                last = stats["requests"]
+                print_stats(stats)
+
+    if args.report > 0:
+        Thread(target=report, daemon=True).start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nStop the undistortion service.")
+    finally:
+        server.server_close()
+        remove(args.socket)
+
+
+if __name__ == "__main__":
+    main()
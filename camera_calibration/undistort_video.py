@@ -0,0 +1,206 @@
+######## Streaming video undistortion for the RPI IR-Cut camera #########
+
+# Author: Petros626
+# Description:
+# The offline undistortion of the calibration works on a folder of PNG images, so a recorded video
+# had to be exploded into frames first. This program streams the frames of a video file through the
+# remap into an encoded output video. Decode, remap and encode run on their own threads and are
+# connected by bounded queues, so they overlap and only a few frames are in memory at any time,
+# independent of the length of the video. Unlike the live pipeline no frame is dropped: a slow
+# stage makes the others wait. A range of frames can be selected and the frames can be cropped to
+# the ROI of the calibration. The FPS, the time per stage and the peak memory are reported.
+
+# Example usage to undistort the frames 100 to 400 of a video and crop them to the ROI:
+# python3 -m camera_calibration video --input=recording.mp4 --output=undistorted.mp4 --start=100 --end=400 --crop
+
+from cv2 import VideoCapture, VideoWriter, VideoWriter_fourcc, CAP_PROP_POS_FRAMES, CAP_PROP_FPS, CAP_PROP_FRAME_COUNT
+from threading import Thread, Event
+from queue import Queue, Full, Empty
+from time import perf_counter
+from resource import getrusage, RUSAGE_SELF
+from argparse import ArgumentParser
+from sys import exit
+from .undistort_maps import undistort_frame
+from .calib_bundle import load_maps
+
+
+# Define VideoUndistorter class to undistort a video file frame by frame
+class VideoUndistorter():
+    # Constructor with instance attributes
+    def __init__(self, input_file, output_file, calib="calibrate_camera.json", alpha=0, crop=False, sensor_crop=None,
+                 fourcc="mp4v", queue_size=8):
+        self.video = VideoCapture(input_file)
+        if not self.video.isOpened():
+            raise ValueError("Video '{}' can't be opened.".format(input_file))
+        ret, frame = self.video.read()
+        if not ret:
+            raise ValueError("Video '{}' has no frames.".format(input_file))
+        self.size = (frame.shape[1], frame.shape[0])
+        self.fps = self.video.get(CAP_PROP_FPS) or 30
+        self.frame_count = int(self.video.get(CAP_PROP_FRAME_COUNT))
+        _, _, self.map1, self.map2, _, self.roi = load_maps(calib, self.size, alpha, crop=sensor_crop)
+        self.crop = crop
+        out_size = tuple(self.roi[2:]) if crop else self.size
+        self.writer = VideoWriter(output_file, VideoWriter_fourcc(*fourcc), self.fps, out_size)
+        if not self.writer.isOpened():
+            raise ValueError("Video '{}' can't be written with the codec '{}'.".format(output_file, fourcc))
+        self.queue_size = queue_size
+        self.stop = Event()
+        self.errors = []
+        self.durations = {"decode": 0.0, "remap": 0.0, "encode": 0.0}
+        self.frames = 0
+
+    # Function to read the frames start to end (exclusive, None = end of the video)
+    def decode(self, start=0, end=None):
+        self.video.set(CAP_PROP_POS_FRAMES, start)
+        index = start
+        while end is None or index < end:
+            begin = perf_counter()
+            ret, frame = self.video.read()
+            self.durations["decode"] += perf_counter() - begin
+            if not ret:
+                break
+            yield frame
+            index += 1
+
+    # Function to undistort a frame and crop it to the ROI
+    def remap(self, frame):
+        begin = perf_counter()
+        dst = undistort_frame(frame, self.map1, self.map2)
+        if self.crop:
+            x, y, w, h = self.roi
+            dst = dst[y:y+h, x:x+w]
+        self.durations["remap"] += perf_counter() - begin
+        return dst
+
+    # Function to encode a frame into the output video
+    def encode(self, frame):
+        begin = perf_counter()
+        self.writer.write(frame)
+        self.durations["encode"] += perf_counter() - begin
+        self.frames += 1
+
+    # Function to put an item into a queue, waits while the queue is full until a stage failed
+    def put(self, queue, item):
+        while not self.stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    # Function to get an item of a queue, None if a stage failed
+    def get(self, queue):
+        while not self.stop.is_set():
+            try:
+                return queue.get(timeout=0.1)
+            except Empty:
+                pass
+        return None
+
+    # Function to run a stage on its own thread, the end of the stream (None) is passed on
+    def stage(self, produce, queue):
+        try:
+            for item in produce():
+                if not self.put(queue, item):
+                    return
+            self.put(queue, None)
+        except Exception as e:
+            self.errors.append(e)
+            self.stop.set()
+
+    # Function to remap the frames of one queue into the next
+    def remap_stage(self, decoded):
+        while True:
+            frame = self.get(decoded)
+            if frame is None:
+                return
+            yield self.remap(frame)
+
+    # Function to undistort the frames start to end. With a queue size of 0 the stages run one after
+    # the other on the calling thread (for comparison).
+    def run(self, start=0, end=None):
+        begin = perf_counter()
+        if self.queue_size == 0:
+            for frame in self.decode(start, end):
+                self.encode(self.remap(frame))
+        else:
+            decoded, remapped = Queue(self.queue_size), Queue(self.queue_size)
+            threads = [Thread(target=self.stage, args=(lambda: self.decode(start, end), decoded), daemon=True),
+                       Thread(target=self.stage, args=(lambda: self.remap_stage(decoded), remapped), daemon=True)]
+            for thread in threads:
+                thread.start()
+            # Encoding runs on the calling thread
+            try:
+                while True:
+                    frame = self.get(remapped)
+                    if frame is None:
+                        break
+                    self.encode(frame)
+            except Exception as e:
+                self.errors.append(e)
+            finally:
+                self.stop.set()
+                for thread in threads:
+                    thread.join()
+        self.elapsed = perf_counter() - begin
+        if self.errors:
+            raise self.errors[0]
+        return self.frames
+
+    # Function to print the FPS, the time per stage and the peak memory
+    def print_report(self):
+        print("{} frames undistorted in {:.2f} s ({:.1f} FPS).".format(self.frames, self.elapsed, self.frames / self.elapsed if self.elapsed else 0))
+        if self.frames:
+            print(" | ".join("{} {:.2f} ms".format(stage, 1000 * duration / self.frames) for stage, duration in self.durations.items()))
+        # ru_maxrss is given in kB on Linux
+        print("Peak RSS: {:.1f} MB".format(getrusage(RUSAGE_SELF).ru_maxrss / 1e3))
+
+    # Function to close the input and the output video
+    def close(self):
+        self.video.release()
+        self.writer.release()
+
+
+# Function to run the command line interface
+def main(argv=None):
+    parser = ArgumentParser()
+    parser.add_argument("--input", required=True, help = "Video file with the distorted frames.")
+    parser.add_argument("--output", help = "Video file for the undistorted frames.",
+                        default = "undistorted.mp4")
+    parser.add_argument("--calib", help = "Calibration file with the camera parameters.",
+                        default = "calibrate_camera.json")
+    parser.add_argument("--alpha", type=float, help = "Free scaling parameter of the optimal camera matrix (0 = only valid pixels, 1 = all pixels).",
+                        default = 0)
+    parser.add_argument("--start", type=int, help = "First frame of the range.",
+                        default = 0)
+    parser.add_argument("--end", type=int, help = "Frame after the last frame of the range (default: end of the video).",
+                        default = None)
+    parser.add_argument("--crop", action="store_true", help = "Crop the undistorted frames to the ROI.")
+    parser.add_argument("--sensor-crop", help = "Sensor crop x,y,w,h (sensor pixels) of the recording, if it differs from the calibration.",
+                        default = None)
+    parser.add_argument("--codec", help = "FourCC of the output codec.",
+                        default = "mp4v")
+    parser.add_argument("--queue", type=int, help = "Number of frames between the stages (0 = decode, remap and encode one after the other).",
+                        default = 8)
+    args = parser.parse_args(argv)
+
+    try:
+        undistorter = VideoUndistorter(args.input, args.output, args.calib, args.alpha, args.crop,
+                                       tuple(map(int, args.sensor_crop.split(","))) if args.sensor_crop else None,
+                                       args.codec, args.queue)
+    except ValueError as e:
+        print(e)
+        exit(1)
+    print("Undistort {} ({}x{}, {} frames, {:g} FPS) -> {}.".format(
+        args.input, undistorter.size[0], undistorter.size[1], undistorter.frame_count, undistorter.fps, args.output))
+    try:
+        undistorter.run(args.start, args.end)
+    finally:
+        undistorter.close()
+    undistorter.print_report()
+
+
+if __name__ == "__main__":
+    main()
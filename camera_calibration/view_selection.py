@@ -0,0 +1,78 @@
+######## View selection for the camera calibration #########
+
+# Author: Petros626
+# Description:
+# The solve time of calibrateCamera grows with the number of views, but near duplicate poses (e.g.
+# from a burst of captures) add cost without improving the accuracy. This module describes every
+# view by the position of the board on the sensor, its scale and its tilt (ratio of the opposite
+# board edges) and picks a bounded, diverse subset by farthest point sampling in this feature space.
+# The first view is the largest board, every further view is the one most different from the
+# views already picked. The coverage of the sensor is reported for all views and the subset.
+
+# Example usage to calibrate with at most 20 diverse views and to compare them with all views:
+# python3 -m camera_calibration calibrate --imgdir=calib_images --savedir=undistorted_images --max-views=20 --compare-views
+
+from cv2 import solvePnP, projectPoints
+from numpy import array, asarray, float64, log, sqrt, zeros, roll, bool_
+
+# Weights of the features: board center x/y, scale, horizontal and vertical tilt
+FEATURE_WEIGHTS = array([1.0, 1.0, 1.0, 0.5, 0.5])
+
+
+# Function to describe a view by board center (normalised to the image size), scale (square root
+# of the board area relative to the image area) and tilt (log ratio of the opposite board edges)
+def view_features(corners, board, img_size):
+    w, h = img_size
+    grid = asarray(corners, dtype=float64).reshape(board[1], board[0], 2)
+    top_left, top_right, bottom_right, bottom_left = grid[0, 0], grid[0, -1], grid[-1, -1], grid[-1, 0]
+    quad = array([top_left, top_right, bottom_right, bottom_left])
+    # Shoelace formula for the area of the board outline
+    x, y = quad[:, 0], quad[:, 1]
+    area = 0.5 * abs((x * roll(y, -1)).sum() - (y * roll(x, -1)).sum())
+    center = grid.reshape(-1, 2).mean(axis=0)
+
+    def length(a, b):
+        return sqrt(((a - b) ** 2).sum())
+
+    tilt_x = log(length(top_right, bottom_right) / length(top_left, bottom_left))
+    tilt_y = log(length(bottom_left, bottom_right) / length(top_left, top_right))
+    return array([center[0] / w, center[1] / h, sqrt(area / (w * h)), tilt_x, tilt_y])
+
+
+# Function to pick at most max_views diverse views, returns the sorted indices of the views
+def select_views(features, max_views):
+    features = asarray(features, dtype=float64) * FEATURE_WEIGHTS
+    if len(features) <= max_views:
+        return list(range(len(features)))
+    # Start with the largest board, it constrains the focal length and the distortion best
+    selected = [int(features[:, 2].argmax())]
+    distance = sqrt(((features - features[selected[0]]) ** 2).sum(axis=1))
+    while len(selected) < max_views:
+        index = int(distance.argmax())
+        selected.append(index)
+        distance = distance.clip(max=sqrt(((features - features[index]) ** 2).sum(axis=1)))
+    return sorted(selected)
+
+
+# Function to get the fraction of the cells of a grid over the sensor which contain at least one corner
+def sensor_coverage(imgpoints, img_size, cells=(8, 6)):
+    w, h = img_size
+    covered = zeros((cells[1], cells[0]), dtype=bool_)
+    for corners in imgpoints:
+        points = asarray(corners, dtype=float64).reshape(-1, 2)
+        cx = (points[:, 0] * cells[0] / w).astype(int).clip(0, cells[0] - 1)
+        cy = (points[:, 1] * cells[1] / h).astype(int).clip(0, cells[1] - 1)
+        covered[cy, cx] = True
+    return covered.mean()
+
+
+# Function to get the re-projection RMS in px of the intrinsics over the given views, the poses are
+# estimated with solvePnP, so views which weren't part of the calibration can be evaluated too
+def evaluate_intrinsics(mtx, dist, objpoints, imgpoints):
+    squared_sum, count = 0.0, 0
+    for objp, corners in zip(objpoints, imgpoints):
+        ret, rvec, tvec = solvePnP(objp, corners, mtx, dist)
+        projected = projectPoints(objp, rvec, tvec, mtx, dist)[0]
+        squared_sum += ((asarray(corners, dtype=float64) - projected) ** 2).sum()
+        count += len(projected)
+    return sqrt(squared_sum / count)
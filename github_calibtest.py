@@ -17,23 +17,24 @@
 # https://docs.opencv.org/4.x/dc/dbb/tutorial_py_calibration.html
 # https://betterprogramming.pub/how-to-calibrate-a-camera-using-python-and-opencv-23bab86ca194
 
-from picamera2 import Picamera2
 from argparse import ArgumentParser
-from keyboard import is_pressed
-from termios import tcflush, TCIOFLUSH
-from sys import stdin, exit
-from libcamera import controls
-from json import load
-from numpy import array, float64
+from sys import exit
+from camera_calibration.calib_bundle import load_parameters
+from camera_calibration.frame_sources import open_source, KeyboardInput, ScriptedInput
 from cv2 import (
     cvtColor, COLOR_RGBA2RGB, undistort, imshow, getOptimalNewCameraMatrix, destroyAllWindows,
     namedWindow, WINDOW_NORMAL, startWindowThread, resizeWindow, moveWindow
 )
-import cProfile
+from time import perf_counter
 
 parser = ArgumentParser()
 parser.add_argument("--res", help = "Required resolution in WxH. To avoid erros find out about the supported resolutions of your camera model.",
                        default = "1920x1080")
+parser.add_argument("--source", help = "Frame source: 'camera', a directory of images or a video file to replay.",
+                       default = "camera")
+parser.add_argument("--fps", type=float, help = "Target FPS of a replayed source (0 = as fast as possible).",
+                       default = 0)
+parser.add_argument("--headless", action="store_true", help = "Run without preview window and keyboard until the replayed source ends.")
 args = parser.parse_args()
 
 if not "x" in args.res:
@@ -41,26 +42,21 @@ if not "x" in args.res:
     exit()
 imgW, imgH = map(int, args.res.split("x"))
 
-tuning_file = Picamera2.load_tuning_file("ov5647_custom.json")
-picam2 = Picamera2(tuning=tuning_file)
-# Set options for saving images
-picam2.options["quality"] = 95 # best quality
-picam2.options["compress_level"] = 0 # no compression
-
-picam2.configure(picam2.create_preview_configuration(main={"format": "RGB888", "size": (1920, 1080)}, controls={"NoiseReductionMode":controls.draft.NoiseReductionModeEnum.HighQuality}))
-picam2.start()
+source = open_source(args.source, (imgW, imgH), args.fps)
+keys = ScriptedInput() if args.headless else KeyboardInput()
+source.start()
 
 winname = "Calibrated (undistorted) Image taker"
-namedWindow(winname, WINDOW_NORMAL)
-resizeWindow(winname, 1000, 900)
-moveWindow(winname, 915, 72)
-startWindowThread()
+if not args.headless:
+    namedWindow(winname, WINDOW_NORMAL)
+    resizeWindow(winname, 1000, 900)
+    moveWindow(winname, 915, 72)
+    startWindowThread()
 key_flag = 0
+timings = []
 
-with open("calibrate_camera.json", "r") as f:
-    calibration_file = load(f)
-mtx = array(calibration_file["mtx"], dtype=float64)
-dist = array(calibration_file["dist"], dtype=float64)
+# Camera matrix of this mode, derived from the resolution and crop of the calibration
+mtx, dist = load_parameters("calibrate_camera.json", source.size, source.crop)
 
 try:
     while 1:
@@ -71,24 +67,31 @@ try:
             #array = request.make_array("main")
             
             #2 direct capture -faster ?
-            array = picam2.capture_array("main")
+            array = source.capture()
+            if array is None:
+                break
             
             #new_cv_img = cvtColor(array, COLOR_RGBA2RGB)
             h, w = array.shape[:2]
             optimal_camera_matrix, roi = getOptimalNewCameraMatrix(mtx, dist, (w, h), 0, (w, h))
+            # Time the undistortion itself, the stage benchmark is camera_calibration/benchmark_stages.py
+            start = perf_counter()
             dst = undistort(array, mtx, dist, None, optimal_camera_matrix)
-            cProfile.run('undistort(array, mtx, dist, None, optimal_camera_matrix)', sort='cumulative')
-            imshow(winname, dst)
+            timings.append((perf_counter() - start) * 1000)
+            if not args.headless:
+                imshow(winname, dst)
             #request.release()
         else:
             key_flag = 0
          
-        if is_pressed("q"):
+        if keys.is_pressed("q"):
             print("\r++++++++++++++++++++++++++++++++++++++++++++++")
             print("\rInterruption: stop preview and close camera...")
             break      
 finally:
-    destroyAllWindows()
-    picam2.stop()
-    picam2.close()
-    tcflush(stdin, TCIOFLUSH)
+    if timings:
+        print("\rundistort: {:.2f} ms mean, {:.2f} ms min over {} frames".format(sum(timings) / len(timings), min(timings), len(timings)))
+    if not args.headless:
+        destroyAllWindows()
+    source.close()
+    keys.close()